@@ -0,0 +1,187 @@
+import math
+import json
+import argparse
+import numpy as np
+from imu_log import read_samples
+from segment_writer import read_index
+from time_align import SECONDS_PER_WEEK
+
+'''
+Overlapping Allan deviation of IMU sample logs
+
+Sample logs are memory-mapped and read in CHUNK-sized slices, so hours of 1 kHz data never
+have to fit in memory more than once per axis. Each axis is integrated once (after taking
+out its mean, which keeps the running sum small enough for float64), and every averaging
+time m * tau0 is then one pass of second differences over that integral:
+
+    avar(m tau0) = sum (theta[k + 2m] - 2 theta[k + m] + theta[k])^2 / (2 (m tau0)^2 (n - 2m + 1))
+
+From the curve, white noise (velocity random walk for accelerometers, angle random walk
+for gyros) is read off the -1/2 slope at tau = 1 s, bias instability is the minimum
+divided by sqrt(2 ln 2 / pi), and rate random walk comes from the +1/2 slope at tau = 3 s.
+
+    python allan.py <imu .bin, .index or convert_logs .npz> [--columns x y z] [--output adev.npz]
+'''
+
+CHUNK = 1 << 20
+TAUS_PER_DECADE = 10
+BIAS_FACTOR = math.sqrt(2 * math.log(2) / math.pi) # 0.664
+G = 9.80665
+
+def load_segments(path):
+    """
+    Structured arrays (memory-mapped for sample logs) holding the capture, in time order
+    """
+    if path.endswith('.npz'):
+        return [np.load(path)]
+    paths = [segment[0] for segment in read_index(path)] if path.endswith('.index') else [path]
+    return [read_samples(segment)[1] for segment in paths]
+
+def chunks(segments, column):
+    for segment in segments:
+        values = segment[column]
+        for start in range(0, len(values), CHUNK):
+            yield np.asarray(values[start:start + CHUNK], dtype=np.float64)
+
+def sample_period(segments):
+    """
+    (median step of the GPS timestamps, samples the span between the first and last should hold)
+    """
+    first = segments[0]
+    last = segments[-1]
+    steps = np.diff(np.asarray(first['time_of_week'][:CHUNK], dtype=np.float64))
+    steps = steps[steps > 0]
+    if not len(steps):
+        raise ValueError("not enough timestamped samples to find the sample rate")
+    tau0 = float(np.median(steps))
+    span = ((int(last['week_number'][-1]) - int(first['week_number'][0])) * SECONDS_PER_WEEK
+            + float(last['time_of_week'][-1]) - float(first['time_of_week'][0]))
+    return tau0, int(round(span / tau0)) + 1
+
+def integrate(segments, column, tau0):
+    """
+    theta[k] = tau0 * sum of the first k mean-removed samples of a column, skipping NaN rows
+    Returns (theta, mean, the column's own sample period)
+    """
+    total = 0.0
+    count = 0
+    rows = 0
+    for values in chunks(segments, column):
+        valid = values[~np.isnan(values)]
+        total += valid.sum()
+        count += len(valid)
+        rows += len(values)
+    if count < 3:
+        raise ValueError(f"column {column} has too few samples")
+    mean = total / count
+    # Slower fields only appear in every few rows of the stream
+    tau0 *= round(rows / count)
+    theta = np.empty(count + 1)
+    theta[0] = 0.0
+    position = 0
+    for values in chunks(segments, column):
+        valid = values[~np.isnan(values)] - mean
+        part = theta[position + 1:position + 1 + len(valid)]
+        np.cumsum(valid, out=part)
+        part += theta[position]
+        position += len(valid)
+    theta[1:] *= tau0
+    return theta, mean, tau0
+
+def averaging_factors(count, taus_per_decade = TAUS_PER_DECADE):
+    """
+    Log-spaced m values up to a quarter of the record, where the estimate still has many terms
+    """
+    largest = max(1, count // 4)
+    return np.unique(np.round(np.logspace(0, math.log10(largest), int(math.log10(largest) * taus_per_decade) + 1)).astype(np.int64))
+
+def overlapping_adev(theta, tau0, factors):
+    """
+    Overlapping Allan deviation of the series whose scaled integral is theta, at tau = factors * tau0
+    """
+    n = len(theta) - 1
+    adev = np.empty(len(factors))
+    for i, m in enumerate(factors):
+        terms = n - 2 * m + 1
+        total = 0.0
+        for start in range(0, terms, CHUNK):
+            stop = min(terms, start + CHUNK)
+            difference = theta[start + 2 * m:stop + 2 * m] - 2 * theta[start + m:stop + m] + theta[start:stop]
+            total += np.dot(difference, difference)
+        adev[i] = math.sqrt(total / (2 * (m * tau0) ** 2 * terms))
+    return factors * tau0, adev
+
+def noise_parameters(tau, adev):
+    """
+    White noise coefficient (at tau = 1 s), bias instability and rate random walk (at tau = 3 s)
+    from the Allan deviation curve, in the column's units
+    """
+    log_tau = np.log10(tau)
+    log_adev = np.log10(adev)
+    slope = np.diff(log_adev) / np.diff(log_tau)
+    minimum = int(np.argmin(adev))
+    parameters = {
+        'bias_instability': float(adev[minimum] / BIAS_FACTOR),
+        'bias_instability_tau': float(tau[minimum]),
+    }
+    if minimum > 0:
+        # Segment before the minimum closest to the -1/2 slope of white noise
+        i = int(np.argmin(np.abs(slope[:minimum] + 0.5)))
+        parameters['white_noise'] = float(10 ** (log_adev[i] + 0.5 * log_tau[i]))
+        parameters['white_noise_slope'] = float(slope[i])
+    if minimum < len(slope):
+        i = minimum + int(np.argmin(np.abs(slope[minimum:] - 0.5)))
+        parameters['rate_random_walk'] = float(10 ** (log_adev[i] - 0.5 * log_tau[i] + 0.5 * math.log10(3)))
+        parameters['rate_random_walk_slope'] = float(slope[i])
+    return parameters
+
+def analyse(path, columns = ('x', 'y', 'z'), taus_per_decade = TAUS_PER_DECADE):
+    """
+    Return ({column: (tau, adev)}, {column: noise parameters}, (rows, rows the time span should hold))
+    """
+    segments = load_segments(path)
+    tau0, expected = sample_period(segments)
+    curves = {}
+    parameters = {}
+    for column in columns:
+        theta, mean, column_tau0 = integrate(segments, column, tau0)
+        samples = len(theta) - 1
+        tau, adev = overlapping_adev(theta, column_tau0, averaging_factors(samples, taus_per_decade))
+        # One integral at a time, so peak memory is a single axis
+        del theta
+        curves[column] = (tau, adev)
+        parameters[column] = dict(noise_parameters(tau, adev), mean=mean, samples=samples, tau0=column_tau0)
+    return curves, parameters, (sum(len(segment['time_of_week']) for segment in segments), expected)
+
+def describe(column, parameters):
+    """
+    One line of the usual datasheet units: accelerometers in ug and ug/rtHz, gyros in deg/h and deg/rth
+    """
+    if column.startswith('gyro'):
+        white = parameters.get('white_noise', math.nan) * 180 / math.pi * 60
+        return (f"{column}: ARW {white:.4f} deg/rt(h), bias instability {parameters['bias_instability'] * 180 / math.pi * 3600:.3f} deg/h "
+                f"at {parameters['bias_instability_tau']:.1f} s")
+    white = parameters.get('white_noise', math.nan)
+    return (f"{column}: VRW {white:.3e} m/s/rt(s) ({white / G * 1e6:.1f} ug/rt(Hz), {white * 60:.4f} m/s/rt(h)), "
+            f"bias instability {parameters['bias_instability'] / G * 1e6:.2f} ug at {parameters['bias_instability_tau']:.1f} s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Overlapping Allan deviation of an IMU capture")
+    parser.add_argument('path', help="sample log segment, run .index, or convert_logs .npz")
+    parser.add_argument('--columns', nargs='+', default=['x', 'y', 'z'])
+    parser.add_argument('--taus-per-decade', type=int, default=TAUS_PER_DECADE)
+    parser.add_argument('--output', help="save tau, the curves and the noise parameters to this .npz")
+    args = parser.parse_args()
+
+    curves, parameters, (rows, expected) = analyse(args.path, args.columns, args.taus_per_decade)
+    if rows < expected:
+        print(f"warning: {expected - rows} of {expected} samples missing (see gap_detector.py); "
+              f"Allan deviation assumes an unbroken record")
+    for column in args.columns:
+        print(describe(column, parameters[column]))
+    if args.output:
+        arrays = {}
+        for column, (tau, adev) in curves.items():
+            arrays[f'{column}_tau'] = tau
+            arrays[f'{column}_adev'] = adev
+        np.savez(args.output, parameters=np.array(json.dumps(parameters)), **arrays)
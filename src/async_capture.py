@@ -0,0 +1,221 @@
+import os
+import time
+import asyncio
+import termios
+from datetime import datetime
+from supervisor import StreamHealth, report_health, report_metrics
+from metrics import StreamMetrics
+from imu_datastream import MipFramer, ConsoleStatus, initialize_imu, sync_stream, decode_frame
+from gnss_datastream import UbxFramer, initialize_gnss, rawx_time
+from segment_writer import SegmentWriter
+from imu_log import SampleLog
+from publisher import Publisher
+from gap_detector import GapDetector
+from stream_spec import sample_interval
+
+'''
+Single event loop capture
+
+Both serial ports are read without blocking through the event loop's reader callbacks,
+so the IMU and GNSS readers, the sample and rawx writers, health reports and any other
+task share one thread instead of a thread per port blocked in serial.Serial.read.
+imu_samples and ubx_frames are the async counterparts of read_stream_data and read_gnss.
+'''
+
+class SerialStream:
+    """
+    Non-blocking reads from an open serial port's file descriptor
+    Waits for data by registering the descriptor with the loop only while nothing is waiting,
+    so an idle port costs nothing and a busy one is read without a callback per byte
+    """
+    def __init__(self, port, metrics = None):
+        self.port = port
+        self.fd = port.fileno()
+        # pyserial leaves VMIN at 0, where an empty port reads as b'' instead of EAGAIN
+        attributes = termios.tcgetattr(self.fd)
+        attributes[6][termios.VMIN] = 1
+        attributes[6][termios.VTIME] = 0
+        termios.tcsetattr(self.fd, termios.TCSANOW, attributes)
+        os.set_blocking(self.fd, False)
+        self.metrics = metrics
+
+    async def readable(self):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(self.fd, ready.set_result, None)
+        try:
+            await ready
+        finally:
+            loop.remove_reader(self.fd)
+
+    async def readinto(self, buffer):
+        """
+        Fill as much of buffer as has arrived, waiting for at least one byte
+        """
+        while True:
+            start = time.perf_counter_ns()
+            try:
+                count = os.readv(self.fd, [buffer])
+            except BlockingIOError:
+                await self.readable()
+                continue
+            if count == 0:
+                raise EOFError(f"{self.port.port} closed")
+            if self.metrics:
+                self.metrics.read.record(time.perf_counter_ns() - start)
+                self.metrics.reads += 1
+                self.metrics.bytes_in += count
+            return count
+
+    async def read(self, size = 4096):
+        buffer = bytearray(size)
+        return bytes(buffer[:await self.readinto(buffer)])
+
+    def close(self):
+        self.port.close()
+
+async def imu_samples(stream, log, framer, metrics = None):
+    """
+    Yield every decoded IMU sample as it arrives, None for a frame that failed validation
+    """
+    clock = time.perf_counter_ns
+    while True:
+        start = clock()
+        failures = framer.checksum_failures
+        raw_data = framer.next_frame()
+        if raw_data is None:
+            framer.feed(await stream.read())
+            continue
+        if framer.checksum_failures != failures:
+            # Logged only; the status line already counts them
+            log.write(framer.last_error + '\n')
+        data = decode_frame(raw_data, log)
+        if metrics:
+            metrics.parse.record(clock() - start)
+        yield data
+
+async def ubx_frames(stream, framer):
+    """
+    Yield every checksum-valid UBX message; like UbxFramer.frames the views last until the next read
+    """
+    while True:
+        failures = framer.checksum_failures
+        for frame in framer.frames():
+            yield frame
+        if framer.checksum_failures != failures:
+            print(framer.last_error)
+        framer.end += await stream.readinto(framer.reserve(len(framer.buffer)))
+
+async def read_imu(stream, log, framer, samples, health, metrics, pending, gaps):
+    async for data in imu_samples(stream, log, framer, metrics):
+        if data is None:
+            metrics.descriptor_failures += 1
+            health.error()
+            continue
+        start = time.perf_counter_ns()
+        samples.write(data)
+        gaps.update(data['week_number'], data['time_of_week'])
+        pending.append(data)
+        metrics.write.record(time.perf_counter_ns() - start)
+        health.packet()
+
+async def read_gnss(stream, rawx, health, metrics, publisher):
+    async for frame in ubx_frames(stream, metrics.framer):
+        start = time.perf_counter_ns()
+        rawx.write(frame, rawx_time(frame))
+        if publisher:
+            publisher.publish_frames([bytes(frame)])
+        metrics.write.record(time.perf_counter_ns() - start)
+        health.packet()
+
+async def run_stream(reader, health):
+    """
+    Task body: the async counterpart of supervisor.run_stream
+    """
+    health.started = time.monotonic()
+    health.running = True
+    try:
+        await reader
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        health.exception = e
+        print(f"{health.name} stream failed: {e!r}")
+    finally:
+        health.running = False
+
+async def capture(imu_port, gnss_port, log_file, sample_prefix, sensor_config, gnss_baud,
+                  max_bytes, max_seconds, flush_interval, status_interval, report_interval, stall_timeout,
+                  metrics_file, metrics_address, publish):
+    health = {'GNSS': StreamHealth('GNSS'), 'IMU': StreamHealth('IMU')}
+    log = open(log_file, 'a')
+    imu_framer = MipFramer()
+    imu_metrics = StreamMetrics('IMU', imu_framer)
+    gnss_metrics = StreamMetrics('GNSS', UbxFramer())
+    health['IMU'].metrics = imu_metrics
+    health['GNSS'].metrics = gnss_metrics
+    imu_port = initialize_imu(log, imu_port)
+    sync_stream(imu_port, log, imu_framer)
+    imu = SerialStream(imu_port, imu_metrics)
+    gnss = SerialStream(initialize_gnss(log_file, gnss_port, gnss_baud), gnss_metrics)
+    samples = SampleLog(sample_prefix, sensor_config, max_bytes, max_seconds)
+    rawx = SegmentWriter("./rawx/rawx" + log_file[10:-4], ".ubx", max_bytes = max_bytes, max_seconds = max_seconds)
+    publisher = Publisher(stream=(sensor_config or {}).get('stream'), **publish) if publish else None
+    status = ConsoleStatus(imu_framer, None, status_interval)
+    gaps = GapDetector(sample_interval((sensor_config or {}).get('stream')), log)
+    pending = []
+
+    async def flush():
+        # Batches the slow work the threaded readers hand to their writer threads
+        while True:
+            await asyncio.sleep(flush_interval)
+            if pending:
+                if publisher:
+                    publisher.publish_samples(pending)
+                status.update(samples.samples, pending[-1])
+                pending.clear()
+            samples.flush()
+            rawx.flush()
+            log.flush()
+
+    async def report():
+        while True:
+            await asyncio.sleep(report_interval)
+            report_health(health, log_file, stall_timeout)
+            report_metrics(health, metrics_file, metrics_address)
+
+    readers = [asyncio.create_task(run_stream(read_imu(imu, log, imu_framer, samples, health['IMU'], imu_metrics, pending, gaps), health['IMU'])),
+               asyncio.create_task(run_stream(read_gnss(gnss, rawx, health['GNSS'], gnss_metrics, publisher), health['GNSS']))]
+    background = [asyncio.create_task(flush()), asyncio.create_task(report())]
+    try:
+        await asyncio.gather(*readers)
+    finally:
+        for task in readers + background:
+            task.cancel()
+        await asyncio.gather(*readers, *background, return_exceptions=True)
+        imu.close()
+        gnss.close()
+        samples.close()
+        rawx.close()
+        if publisher:
+            publisher.close()
+        log.write(f"{samples.samples} samples written to {sample_prefix}_*.bin\n")
+        gaps.write_report(sample_prefix + "_gaps.json")
+        log.write(f"IMU completeness: {gaps.summary()}\n")
+        log.close()
+        report_health(health, log_file, stall_timeout)
+        report_metrics(health, metrics_file, metrics_address)
+    return health
+
+def run_async_capture(imu_port = '/dev/ttyS0', gnss_port = '/dev/ttyACM0', log_file = 'log.txt', sample_prefix = 'imu',
+                      sensor_config = None, gnss_baud = 9600, max_bytes = 64 << 20, max_seconds = 3600, flush_interval = 0.25,
+                      status_interval = 1.0, report_interval = 10.0, stall_timeout = 5.0, metrics_file = None,
+                      metrics_address = None, publish = None):
+    """
+    Capture both streams in one event loop until Ctrl-C; the single-thread counterpart of supervisor.run_capture
+    """
+    try:
+        asyncio.run(capture(imu_port, gnss_port, log_file, sample_prefix, sensor_config, gnss_baud, max_bytes, max_seconds,
+                            flush_interval, status_interval, report_interval, stall_timeout, metrics_file, metrics_address, publish))
+    except KeyboardInterrupt:
+        print(f"\nStopping capture at {datetime.now().strftime('%Y-%m-%d_%H-%M-%S.%f')}")
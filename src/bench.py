@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import threading
+import platform
+import tempfile
+import numpy as np
+from checksum import fletcher_checksum
+from configuration import GNSS_CONFIG, compile_gnss_config, load_gnss_config
+from gnss_datastream import UbxFramer
+from imu_datastream import MipFramer, read_stream_data, parse_stream_data
+from imu_log import SampleLog
+from replay import ReplaySerial, load_capture
+from stream_spec import DEFAULT_STREAM, sample_interval
+
+'''
+Benchmarks for the capture hot paths
+
+Each benchmark reports packets/s, bytes/s and per-packet latency percentiles and the
+results are saved as JSON. A run fails (exit status 1) when a stream path drops below
+HEADROOM times the default IMU stream rate (1000 Hz), or more than TOLERANCE below a saved baseline.
+
+    python bench.py [--imu raw IMU bytes] [--ubx rawx .ubx or .index] [--output results.json] [--baseline results.json]
+'''
+
+IMU_RATE = 1 / sample_interval(DEFAULT_STREAM) # packets/s of the default stream
+HEADROOM = 10 # stream paths must keep up with this many times the IMU rate
+TOLERANCE = 0.25 # allowed slowdown against a baseline
+PERCENTILES = (50, 90, 99, 99.9)
+
+def imu_packet(time_of_week = 345600.0):
+    packet = bytes([0x75, 0x65, 0x80, 0x1C, 0x0E, 0xD3]) + struct.pack('>dHH', time_of_week, 2370, 0) + bytes([0x0E, 0x04]) + struct.pack('>fff', 0.0, 0.0, -1.0)
+    return packet + fletcher_checksum(packet)
+
+def rawx_frame(measurements = 20):
+    payload = struct.pack('<dHbBB3s', 345600.0, 2370, 18, measurements, 1, b'\0\0\0')
+    payload += struct.pack('<ddfBBBBHBBBBBB', 2e7, 1e8, 100.0, 0, 5, 0, 0, 100, 40, 1, 1, 1, 7, 0) * measurements
+    body = bytes([0x02, 0x15]) + struct.pack('<H', len(payload)) + payload
+    return bytes([0xB5, 0x62]) + body + fletcher_checksum(body)
+
+def summarise(latencies, packets, size, elapsed):
+    """
+    Throughput and latency percentiles (microseconds) from per-packet timings in ns
+    """
+    latencies = np.asarray(latencies, dtype=np.float64) / 1e3
+    result = {
+        'packets': packets,
+        'packets_per_second': packets / elapsed,
+        'bytes_per_second': size / elapsed,
+    }
+    if len(latencies):
+        result.update({f'p{percentile}_us': float(np.percentile(latencies, percentile)) for percentile in PERCENTILES})
+        result['max_us'] = float(latencies.max())
+    return result
+
+def bench_checksum(packets):
+    frames = [packet[:-2] for packet in packets]
+    latencies = []
+    clock = time.perf_counter_ns
+    start = time.perf_counter()
+    for frame in frames:
+        before = clock()
+        fletcher_checksum(frame)
+        latencies.append(clock() - before)
+    return summarise(latencies, len(frames), sum(map(len, frames)), time.perf_counter() - start)
+
+def bench_parse(packets):
+    latencies = []
+    clock = time.perf_counter_ns
+    with open(os.devnull, 'w') as log:
+        start = time.perf_counter()
+        for packet in packets:
+            before = clock()
+            parse_stream_data(packet, log)
+            latencies.append(clock() - before)
+    return summarise(latencies, len(packets), sum(map(len, packets)), time.perf_counter() - start)
+
+def bench_read_stream(data):
+    """
+    read_stream_data over a replayed byte stream: framing, validation and decoding together
+    """
+    stop_event = threading.Event()
+    imu = ReplaySerial(data, speed=None, timeout=0, stop_event=stop_event)
+    framer = MipFramer()
+    latencies = []
+    clock = time.perf_counter_ns
+    with open(os.devnull, 'w') as log:
+        start = time.perf_counter()
+        while True:
+            before = clock()
+            if read_stream_data(imu, log, framer, stop_event) is None and stop_event.is_set():
+                break
+            latencies.append(clock() - before)
+    return summarise(latencies, len(latencies), len(data), time.perf_counter() - start)
+
+def bench_ubx_framing(data, chunk = 4096):
+    """
+    UbxFramer over the stream in serial-read sized chunks, as read_gnss uses it
+    """
+    framer = UbxFramer()
+    latencies = []
+    clock = time.perf_counter_ns
+    start = time.perf_counter()
+    for position in range(0, len(data), chunk):
+        piece = data[position:position + chunk]
+        while piece:
+            piece = piece[framer.feed(piece):]
+            before = clock()
+            for frame in framer.frames():
+                latencies.append(clock() - before)
+                before = clock()
+    return summarise(latencies, len(latencies), len(data), time.perf_counter() - start)
+
+def bench_configure_gnss(repeats = 20):
+    """
+    Time to get the GNSS config ready to send, parsed from text and from the cache
+    """
+    results = {}
+    cache = tempfile.NamedTemporaryFile(suffix='.cache', delete=False).name
+    try:
+        for name, build in (('parse', lambda: compile_gnss_config(GNSS_CONFIG)),
+                            ('cached', lambda: load_gnss_config(GNSS_CONFIG, cache))):
+            build()
+            latencies = []
+            start = time.perf_counter()
+            for i in range(repeats):
+                before = time.perf_counter_ns()
+                commands = build()
+                latencies.append(time.perf_counter_ns() - before)
+            results[name] = summarise(latencies, repeats * len(commands), repeats * sum(len(frame) for command, frame in commands), time.perf_counter() - start)
+    finally:
+        os.remove(cache)
+    return results
+
+def bench_sample_log(count):
+    directory = tempfile.mkdtemp()
+    samples = SampleLog(os.path.join(directory, 'bench'))
+    data = {'time_of_week': 345600.0, 'week_number': 2370, 'x': 0.0, 'y': 0.0, 'z': -9.80665}
+    latencies = []
+    clock = time.perf_counter_ns
+    start = time.perf_counter()
+    for i in range(count):
+        before = clock()
+        samples.write(data)
+        latencies.append(clock() - before)
+    samples.close()
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(samples.writer.path)
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    return summarise(latencies, count, size, elapsed)
+
+def run(imu_capture = None, ubx_capture = None, packets = 20000):
+    packet_list = [imu_packet(345600.0 + i / IMU_RATE) for i in range(packets)]
+    imu_stream = b''.join(packet_list)
+    ubx_stream = rawx_frame() * (packets // 20)
+    results = {
+        'checksum': bench_checksum(packet_list),
+        'parse_stream_data': bench_parse(packet_list),
+        'read_stream_data': bench_read_stream(imu_stream),
+        'ubx_framing': bench_ubx_framing(ubx_stream),
+        'configure_gnss': bench_configure_gnss(),
+        'sample_log': bench_sample_log(packets),
+    }
+    if imu_capture:
+        results['read_stream_data_recorded'] = bench_read_stream(load_capture(imu_capture))
+    if ubx_capture:
+        results['ubx_framing_recorded'] = bench_ubx_framing(load_capture(ubx_capture))
+    return results
+
+def check(results, baseline = None):
+    """
+    Return a list of regression messages; empty when everything is within thresholds
+    """
+    failures = []
+    for name in ('parse_stream_data', 'read_stream_data', 'read_stream_data_recorded', 'sample_log'):
+        if name in results and results[name]['packets_per_second'] < HEADROOM * IMU_RATE:
+            failures.append(f"{name}: {results[name]['packets_per_second']:.0f} packets/s is under {HEADROOM}x the {IMU_RATE:.0f} Hz IMU rate")
+    if baseline:
+        for name, result in results.items():
+            reference = baseline.get(name)
+            if not reference or 'packets_per_second' not in result:
+                continue
+            if result['packets_per_second'] < reference['packets_per_second'] * (1 - TOLERANCE):
+                failures.append(f"{name}: {result['packets_per_second']:.0f} packets/s, baseline {reference['packets_per_second']:.0f}")
+    return failures
+
+def report(results, indent = ''):
+    for name, result in results.items():
+        if 'packets_per_second' not in result:
+            print(f"{indent}{name}:")
+            report(result, indent + '  ')
+            continue
+        print(f"{indent}{name:>26}: {result['packets_per_second']:12.0f} packets/s {result['bytes_per_second'] / 1e6:8.2f} MB/s"
+              f"  p50 {result.get('p50_us', 0):8.1f} us  p99 {result.get('p99_us', 0):8.1f} us")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the capture hot paths")
+    parser.add_argument('--imu', help="recorded raw IMU byte stream")
+    parser.add_argument('--ubx', help="recorded rawx .ubx capture or run .index")
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help="earlier results to compare against")
+    args = parser.parse_args()
+
+    results = run(args.imu, args.ubx, args.packets)
+    report(results)
+    with open(args.output, 'w') as out:
+        json.dump({'platform': platform.platform(), 'machine': platform.machine(), 'python': platform.python_version(),
+                   'time': time.time(), 'results': results}, out, indent=2)
+    baseline = json.load(open(args.baseline))['results'] if args.baseline else None
+    failures = check(results, baseline)
+    for failure in failures:
+        print("REGRESSION " + failure)
+    sys.exit(1 if failures else 0)
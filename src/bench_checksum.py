@@ -0,0 +1,30 @@
+import time
+import struct
+from checksum import fletcher_checksum, fletcher_checksum_loop, validate_frames
+
+def main(packets = 100000):
+    '''
+    Compare the checksum implementations on synthetic 34-byte IMU packets
+    '''
+    packet = bytes([0x75, 0x65, 0x80, 0x1C, 0x0E, 0xD3]) + struct.pack('>dHH', 345600.0, 2370, 0) + bytes([0x0E, 0x04]) + struct.pack('>fff', 0.0, 0.0, -1.0)
+    packet += fletcher_checksum(packet)
+    buffer = packet * packets
+    frames = [packet[:32]] * packets
+
+    results = {}
+    for name, function in (('loop', fletcher_checksum_loop), ('accumulate', fletcher_checksum)):
+        start = time.perf_counter()
+        for frame in frames:
+            function(frame)
+        results[name] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    valid = validate_frames(buffer, len(packet))
+    results['numpy batch'] = time.perf_counter() - start
+    assert valid.all()
+
+    for name, elapsed in results.items():
+        print(f"{name:>12}: {packets / elapsed:12.0f} packets/s ({elapsed / packets * 1e6:.3f} us/packet), {results['loop'] / elapsed:6.1f}x loop")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+from itertools import accumulate
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def fletcher_checksum(data):
+    '''
+    Calculate Fletcher checksum for 3DM-CV7-INS and UBX messages
+    data: bytes-like object containing the message to checksum
+    Returns: 2 bytes checksum
+    '''
+    # MSB is the plain byte sum and LSB the sum of the running sums, both mod 256,
+    # so the whole loop reduces to two C-level passes
+    return bytes([sum(data) & 0xFF, sum(accumulate(data)) & 0xFF])
+
+def fletcher_checksum_loop(data):
+    '''
+    Original byte-by-byte implementation, kept as the reference for the benchmark
+    '''
+    MSB = 0
+    LSB = 0
+    for byte in data:
+        MSB = (MSB + byte) & 0xFF  # Ensure 8-bit result using & 0xFF
+        LSB = (LSB + MSB) & 0xFF
+    # Return the two checksum bytes
+    return(bytes([MSB, LSB]))
+
+def batch_checksums(frames):
+    '''
+    Calculate the checksums of many equal-length messages in one call
+    frames: (N, L) uint8 array of message bytes without their checksum
+    Returns: (N, 2) uint8 array of [MSB, LSB]
+    '''
+    if np is None:
+        raise ImportError("batch checksums require numpy")
+    frames = np.asarray(frames, dtype=np.uint8)
+    weights = np.arange(frames.shape[1], 0, -1, dtype=np.uint32)
+    checksums = np.empty((frames.shape[0], 2), dtype=np.uint8)
+    checksums[:, 0] = frames.sum(axis=1, dtype=np.uint32) & 0xFF
+    checksums[:, 1] = (frames.astype(np.uint32) @ weights) & 0xFF
+    return checksums
+
+def validate_frames(buffer, frame_length, offset = 0, count = None, start = 0):
+    '''
+    Validate back-to-back frames of frame_length bytes (checksum included) in one call
+    buffer: bytes-like object holding the frames starting at offset
+    start: index within each frame where the checksummed region begins (2 for UBX sync bytes)
+    Returns: boolean array, True where the frame's trailing checksum matches
+    '''
+    if np is None:
+        raise ImportError("batch checksums require numpy")
+    if count is None:
+        count = (len(buffer) - offset) // frame_length
+    frames = np.frombuffer(buffer, dtype=np.uint8, count=count * frame_length, offset=offset).reshape(count, frame_length)
+    checksums = batch_checksums(frames[:, start:-2])
+    return (checksums == frames[:, -2:]).all(axis=1)
@@ -1,25 +1,64 @@
+import os
 import serial
 import time
 import struct
+import json
+import hashlib
+from collections import deque
 from datetime import datetime
+from checksum import fletcher_checksum
+from gnss_datastream import UbxFramer, UBX_SYNC
+from imu_datastream import MipFramer
+from stream_spec import DEFAULT_STREAM, IMU_BAUD, check_stream, message_format
+
+IMU_DEFAULT_BAUD = 115200 # UART rate of the 3DM-CV7 after power-up
+BAUD_SETTLE = 0.05 # seconds the 3DM-CV7 needs after acknowledging a baud-rate change
+GNSS_CONFIG = "./configs/EVK-M8T-0-01.txt"
+'''
+Compiled GNSS config cache, written next to the config file as <config>.cache
+    magic       4 bytes  b'UBX2'
+    digest      32 bytes SHA-256 of the config file it was built from
+    frames_hash 32 bytes SHA-256 of the frames section, checked instead of every frame's checksum
+    index_len   u32      length of the JSON list of [command name, frame length] that follows
+    index       index_len bytes of UTF-8 JSON
+    frames      ready-to-send UBX frames back to back, checksums included
+'''
+CACHE_MAGIC = b'UBX2'
+CACHE_PREAMBLE = struct.Struct('<4s32s32sI')
+
+GNSS_DEFAULT_BAUD = 9600 # UART1 rate of the EVK-M8T after power-up
+GNSS_BAUD_RATES = (9600, 19200, 38400, 57600, 115200, 230400, 460800)
+GNSS_USB_CAPACITY = 500000 # bytes/s, a conservative figure for the M8T's full-speed USB CDC port
+GNSS_LINK_HEADROOM = 0.8 # warn when the configured messages need more than this share of the link
+RAWX_MAX_MEASUREMENTS = 40 # signals assumed per RXM-RAWX epoch when sizing the link budget
+# Worst-case frame sizes (sync, header and checksum included) of the messages the config can enable
+UBX_FRAME_SIZES = {
+    (0x02, 0x15): 8 + 16 + 32 * RAWX_MAX_MEASUREMENTS, # RXM-RAWX
+    (0x02, 0x13): 8 + 8 + 40, # RXM-SFRBX
+    (0x0D, 0x01): 8 + 16, # TIM-TP
+    (0x01, 0x20): 8 + 16, # NAV-TIMEGPS
+}
+UBX_DEFAULT_FRAME_SIZE = 8 + 100
+NMEA_FRAME_SIZE = 82 # maximum NMEA sentence length
 
 def main(imu_port = '/dev/ttyS0',
         gnss_port = '/dev/ttyACM0',
         gps_offset = [0.0, 0.0, 0.0], 
-        decimation = 0x01, 
-        log_file = 'log.txt'):
+        imu_stream = DEFAULT_STREAM, 
+        log_file = 'log.txt',
+        gnss_baud = 115200):
     
     # Initialize GNSS
     log = start_log(log_file)
-    gnss = initialize_gnss(log, gnss_port)
-    configure_gnss(gnss, log)
+    gnss = initialize_gnss(log, gnss_port, gnss_baud)
+    gnss = configure_gnss(gnss, log, baud = gnss_baud)
     gnss.close()
 
     #Initialize IMU
     imu = initialize_imu(log, imu_port)
     initialize_pps(imu, log)
     initialize_gps(imu, log, gps_offset)
-    initialize_stream(imu, log, decimation)
+    initialize_stream(imu, log, imu_stream)
     imu.close()
     log.close()
     
@@ -27,85 +66,335 @@ def start_log(log_file):
     log = open(log_file, 'a')
     return log
 
-def initialize_gnss(log, gnss_port):
+def initialize_gnss(log, gnss_port, baud = GNSS_DEFAULT_BAUD):
     log.write('\n#################################################################\n')
     log.write(f"GNSS initialization started at {datetime.now().strftime('%Y-%m-%d_%H-%M-%S.%f')} \n")
     log.write('#################################################################\n')
+    if is_usb_port(gnss_port):
+        # The baud rate means nothing to the native USB port, which always runs at full speed
+        gnss = open_gnss(gnss_port, baud)
+    else:
+        gnss = find_gnss_baud(log, gnss_port, baud)
+    
+    print("GNSS initialized successfully")
+    log.write("GNSS initialized successfully\n")
+    return gnss
+
+def open_gnss(gnss_port, baud):
     gnss = serial.Serial(
         port=gnss_port,
-        baudrate=9600, 
+        baudrate=baud, 
         timeout=1)
     
     # Clear any leftover data
     gnss.reset_input_buffer()
     gnss.reset_output_buffer()
-    
-    print("GNSS initialized successfully")
-    log.write("GNSS initialized successfully\n")
     return gnss
 
-def configure_gnss(gnss, log):
-    open_file = open("./configs/EVK-M8T-0-01.txt", "r")
-    for line in open_file:
-        line.strip()
-        linesplit = line.split(" - ")
-        action = "configuring: " + linesplit[0]
-        print(action)
-        log.write(action + "\n")
-        bytestring = bytes([0xB5, 0x62])
-        for byte in linesplit[1].split():
-            bytestring += bytes([int(byte, 16)])
-        checksum = fletcher_checksum(bytestring[2:])
-        while gnss.out_waiting:
-            pass
-        gnss.write(bytestring + checksum)
+def is_usb_port(gnss_port):
+    """
+    True for the receiver's native USB (CDC ACM) port
+    """
+    return "ttyACM" in gnss_port or "usbmodem" in gnss_port
+
+def poll_gnss(gnss, timeout = 0.5):
+    """
+    Poll MON-VER and return True if a valid reply arrives within timeout
+    """
+    body = bytes([0x0A, 0x04, 0x00, 0x00])
+    gnss.reset_input_buffer()
+    gnss.write(UBX_SYNC + body + fletcher_checksum(body))
+    framer = UbxFramer()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        framer.fill(gnss)
+        for frame in framer.frames():
+            if frame[2] == 0x0A and frame[3] == 0x04:
+                return True
+    return False
+
+def find_gnss_baud(log, gnss_port, preferred):
+    """
+    Open a UART-connected receiver at whichever rate it answers on, trying preferred first
+    The receiver may still be at the rate set by an earlier run rather than its power-up default
+    """
+    for baud in (preferred, GNSS_DEFAULT_BAUD) + GNSS_BAUD_RATES:
+        gnss = open_gnss(gnss_port, baud)
+        gnss.timeout = 0.1
+        if poll_gnss(gnss):
+            gnss.timeout = 1
+            message = f"GNSS answering at {baud} baud"
+            print(message)
+            log.write(message + "\n")
+            return gnss
+        gnss.close()
+    message = f"GNSS not answering on {gnss_port}, assuming {GNSS_DEFAULT_BAUD} baud"
+    print(message)
+    log.write(message + "\n")
+    return open_gnss(gnss_port, GNSS_DEFAULT_BAUD)
+
+def configure_gnss(gnss, log, config_path = GNSS_CONFIG, baud = None):
+    """
+    Send the compiled config, then set UART1 (when not on USB) to baud and check the link budget
+    Returns the port, reopened if the baud rate changed
+    """
+    commands = load_gnss_config(config_path)
+    usb = is_usb_port(gnss.port)
+    port_frame = None
+    if not usb:
+        commands, port_frame = uart_commands(commands)
+    acked, nacked, timed_out = send_ubx_commands(gnss, commands, log)
+    message = f"GNSS configured: {len(commands)} messages, {acked} acknowledged, {nacked} rejected, {timed_out} unanswered"
+    print(message)
+    log.write(message + "\n")
+
+    if not usb:
+        # The config's own UART1 CFG-PRT is held back until now, as it would change the rate mid-send
+        if not baud and port_frame is not None:
+            baud = struct.unpack_from('<I', port_frame, 6 + 8)[0]
+        gnss = set_gnss_baud(gnss, log, baud or gnss.baudrate, port_frame)
+    check_gnss_link(commands, GNSS_USB_CAPACITY if usb else gnss.baudrate // 10, 3 if usb else 1, log)
+    return gnss
+
+def uart_commands(commands):
+    """
+    Adapt a config written for the USB port to a receiver on UART1
+    Returns (commands without the UART1 CFG-PRT, that CFG-PRT frame or None); UBX messages
+    the config only enables on USB are enabled at the same rate on UART1
+    """
+    adapted = []
+    port_frame = None
+    for name, frame in commands:
+        if frame[2] == 0x06 and frame[3] == 0x00 and len(frame) == 28 and frame[6] == 0x01:
+            port_frame = frame
+            continue
+        if frame[2] == 0x06 and frame[3] == 0x01 and len(frame) == 16 and frame[6] not in (0xF0, 0xF1) and not frame[9] and frame[11]:
+            body = bytearray(frame[2:-2])
+            body[7] = body[9]
+            frame = UBX_SYNC + bytes(body) + fletcher_checksum(body)
+        adapted.append((name, frame))
+    return adapted, port_frame
+
+def set_gnss_baud(gnss, log, baud, port_frame = None):
+    """
+    Set UART1 to baud with CFG-PRT, keeping the config's protocol masks plus UBX, and reopen the port
+    """
+    if port_frame is not None:
+        payload = bytearray(port_frame[6:-2])
+    else:
+        # 8N1, UBX + NMEA in and out
+        payload = bytearray(struct.pack('<BBHIIHHHH', 0x01, 0, 0, 0x08C0, 0, 0x0003, 0x0003, 0, 0))
+    struct.pack_into('<I', payload, 8, baud)
+    # The capture reads RAWX from this port, so UBX stays on whatever the config asks for
+    in_mask, out_mask = struct.unpack_from('<HH', payload, 12)
+    struct.pack_into('<HH', payload, 12, in_mask | 0x0001, out_mask | 0x0001)
+    body = bytes([0x06, 0x00]) + struct.pack('<H', len(payload)) + payload
+    # The ACK is sent at the new rate and is usually lost, so confirm with a poll instead
+    gnss.write(UBX_SYNC + body + fletcher_checksum(body))
+    gnss.flush()
+    time.sleep(0.1)
+    gnss_port = gnss.port
+    gnss.close()
+    gnss = open_gnss(gnss_port, baud)
+    if poll_gnss(gnss):
+        message = f"GNSS UART1 set to {baud} baud"
+    else:
+        message = f"GNSS not answering after switching to {baud} baud"
+    print(message)
+    log.write(message + "\n")
+    return gnss
+
+def link_budget(commands, port_index):
+    """
+    Estimate the bytes per second the configured messages will put on one receiver port
+    port_index: CFG-MSG rate slot, 1 for UART1 and 3 for USB
+    """
+    epochs = 1.0
+    rates = {}
+    for name, frame in commands:
+        if frame[2] != 0x06:
+            continue
+        if frame[3] == 0x08 and len(frame) >= 10:
+            # CFG-RATE: measurement period in ms
+            period = frame[6] | frame[7] << 8
+            if period:
+                epochs = 1000.0 / period
+        elif frame[3] == 0x01 and len(frame) == 16:
+            # CFG-MSG: message class/id followed by a rate per port, later entries override earlier ones
+            rates[(frame[6], frame[7])] = frame[8 + port_index]
+    total = 0.0
+    for message, rate in rates.items():
+        if not rate:
+            continue
+        if message[0] in (0xF0, 0xF1):
+            size = NMEA_FRAME_SIZE
+        else:
+            size = UBX_FRAME_SIZES.get(message, UBX_DEFAULT_FRAME_SIZE)
+        total += size * epochs / rate
+    return total
+
+def check_gnss_link(commands, capacity, port_index, log):
+    """
+    Log the estimated link load and warn when it approaches the link capacity (bytes/s)
+    """
+    needed = link_budget(commands, port_index)
+    message = f"GNSS link: ~{needed:.0f} B/s of {capacity} B/s"
+    if needed > capacity * GNSS_LINK_HEADROOM:
+        message = "WARNING: " + message + ", messages will back up in the receiver; raise the baud rate or lower the message rates"
+    print(message)
+    log.write(message + "\n")
+    return needed
+
+def compile_gnss_config(config_path):
+    """
+    Parse 'NAME - hex bytes' lines into a list of (name, checksummed UBX frame)
+    """
+    commands = []
+    for line in open(config_path, "r"):
+        if " - " not in line:
+            continue
+        name, payload = line.split(" - ", 1)
+        body = bytes.fromhex(payload)
+        commands.append((name.strip(), UBX_SYNC + body + fletcher_checksum(body)))
+    return commands
+
+def load_gnss_config(config_path, cache_path = None):
+    """
+    Return the compiled commands for a config file, from its cache when the file is unchanged
+    The cache is rebuilt whenever the SHA-256 of the config file no longer matches, or the
+    frames no longer match the hash stored with them
+    """
+    cache_path = cache_path or config_path + ".cache"
+    digest = hashlib.sha256(open(config_path, "rb").read()).digest()
+    try:
+        with open(cache_path, "rb") as cache:
+            blob = cache.read()
+        magic, cached_digest, frames_hash, index_len = CACHE_PREAMBLE.unpack_from(blob)
+        start = CACHE_PREAMBLE.size + index_len
+        if magic == CACHE_MAGIC and cached_digest == digest and hashlib.sha256(blob[start:]).digest() == frames_hash:
+            commands = []
+            for name, length in json.loads(blob[CACHE_PREAMBLE.size:start]):
+                commands.append((name, blob[start:start + length]))
+                start += length
+            return commands
+    except (OSError, struct.error, ValueError):
+        pass
+
+    commands = compile_gnss_config(config_path)
+    index = json.dumps([[name, len(frame)] for name, frame in commands]).encode()
+    frames = b"".join(frame for name, frame in commands)
+    try:
+        # Written aside and renamed, so a crash mid-write never leaves a truncated cache behind
+        with open(cache_path + ".tmp", "wb") as cache:
+            cache.write(CACHE_PREAMBLE.pack(CACHE_MAGIC, digest, hashlib.sha256(frames).digest(), len(index)) + index + frames)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError:
+        pass
+    return commands
+
+def send_ubx_commands(gnss, commands, log, window = 8, timeout = 1.0):
+    """
+    Send (name, frame) commands, keeping up to window CFG messages awaiting ACK-ACK/ACK-NAK
+    Each burst of frames goes out in one write and the next burst is released as replies arrive,
+    so the receiver is never flooded and nothing spins on out_waiting
+    Returns (acknowledged, rejected, unanswered) counts
+    """
+    framer = UbxFramer()
+    queue = deque(commands)
+    pending = deque()  # (name, class, id, deadline) of CFG messages awaiting a reply
+    acked = nacked = timed_out = 0
+    while queue or pending:
+        burst = []
+        while queue and len(pending) < window:
+            name, frame = queue.popleft()
+            action = "configuring: " + name
+            print(action)
+            log.write(action + "\n")
+            burst.append(frame)
+            # Only CFG messages are acknowledged
+            if frame[2] == 0x06:
+                pending.append((name, frame[2], frame[3], time.monotonic() + timeout))
+        if burst:
+            gnss.write(b"".join(burst))
+        if not pending:
+            continue
+
+        framer.fill(gnss)
+        for reply in framer.frames():
+            if reply[2] != 0x05 or len(reply) < 10:
+                continue
+            # Replies to repeated commands (CFG-MSG) arrive in the order they were sent
+            for i, (name, msg_class, msg_id, deadline) in enumerate(pending):
+                if (msg_class, msg_id) == (reply[6], reply[7]):
+                    del pending[i]
+                    if reply[3] == 0x01:
+                        acked += 1
+                    else:
+                        nacked += 1
+                        print(f"{name} rejected (ACK-NAK)")
+                        log.write(f"{name} rejected (ACK-NAK)\n")
+                    break
+        while pending and time.monotonic() > pending[0][3]:
+            name = pending.popleft()[0]
+            timed_out += 1
+            print(f"{name} not acknowledged")
+            log.write(f"{name} not acknowledged\n")
+    return acked, nacked, timed_out
 
 def initialize_imu(log, imu_port):
     '''
     initialize UART port for 3DM-CV7-INS
     Default settings: 115200 baud, 8 data bits, 1 stop bit, no parity
+    The baud change is not saved, so a device that was not power-cycled since an earlier run
+    is still at IMU_BAUD and only answers there
     '''
     log.write('\n#################################################################\n')
     log.write(f"IMU initialization started at {datetime.now().strftime('%Y-%m-%d_%H-%M-%S.%f')} \n")
     log.write('#################################################################\n')
-    
+
+    imu = open_imu(imu_port, IMU_DEFAULT_BAUD)
+    # Set to idle mode first; the baud change goes out alone once idle is acknowledged,
+    # since nothing sent after it can be answered at the old rate
+    idle = [("Set to idle", mip_packet(0x01, 0x02))]
+    if not send_mip_commands(imu, idle, log, retries = 1):
+        check_commands(send_mip_commands(imu, [
+            (f"UART baud rate {IMU_BAUD}", mip_packet(0x01, 0x09, bytes([0x01, 0x01]) + struct.pack('>I', IMU_BAUD))),
+        ], log, window=1), "IMU", log)
+        # The ACK comes back at the old rate; the device needs a moment before it listens at the new one
+        imu.close()
+        time.sleep(BAUD_SETTLE)
+        imu = open_imu(imu_port, IMU_BAUD)
+    else:
+        message = f"IMU not answering at {IMU_DEFAULT_BAUD} baud, trying {IMU_BAUD}"
+        print(message)
+        log.write(message + "\n")
+        imu.close()
+        imu = open_imu(imu_port, IMU_BAUD)
+        check_commands(send_mip_commands(imu, idle, log), "IMU", log)
+    print("IMU initialized successfully")
+    log.write("IMU initialized succesfully\n")
+    return imu
+
+def open_imu(imu_port, baud):
     imu = serial.Serial(
         port=imu_port,
-        baudrate = 115200,
+        baudrate = baud,
         timeout=1
     )
-    
+
     # Clear any leftover data
     imu.reset_input_buffer()
     imu.reset_output_buffer()
-    
-    # Set to idle mode first
-    idle_command = bytes([0x75, 0x65, 0x01, 0x02, 0x02, 0x02])
-    checksum = fletcher_checksum(idle_command)
-    imu.write(idle_command + checksum)
-    ack = imu.read(10)
-    print("IMU initialized successfully")
-    log.write("IMU initialized succesfully\n")
-    command = bytes([0x75, 0x65, 0x01, 0x08, 0x08, 0x09, 0x01, 0x01, 0x00, 0x07, 0x08, 0x00])
-    command += fletcher_checksum(command)
-    imu.write(command)
-    time.sleep(0.25)
-    imu.close()
-    imu = serial.Serial(
-        port=imu_port,
-        baudrate = 460800,
-        timeout=1
-    )
     return imu
 
 def initialize_pps(imu, log):
     """
     Initialize PPS on GPIO3 (1 Hz 25 ms)
     """
-    pps_source = bytes([0x75, 0x65, 0x0C, 0x04, 0x04, 0x28, 0x01, 0x03])
-    pps_source += fletcher_checksum(pps_source)
-    imu.write(pps_source)
-    imu.write(bytes([0x75, 0x65, 0x0C, 0x07, 0x07, 0x41, 0x01, 0x03, 0x02, 0x01, 0x00, 0x3C, 0x6D]))
+    check_commands(send_mip_commands(imu, [
+        ("PPS source", mip_packet(0x0C, 0x28, bytes([0x01, 0x03]))),
+        ("GPIO3 PPS input", mip_packet(0x0C, 0x41, bytes([0x01, 0x03, 0x02, 0x01, 0x00]))),
+    ], log), "PPS", log)
     print("PPS initialized succesfully")
     log.write("PPS initialized succesfully\n")
 
@@ -113,50 +402,113 @@ def initialize_gps(imu, log, gps_offset):
     """
     Initialize GPS at given offset
     """ 
-    #TODO: Fill out
-    #Set GPS offset
-    command = bytes([0x75, 0x65, 0x0D, 0x0F, 0x0F, 0x13, 0x01])
-    command += struct.pack('>f', gps_offset[0])
-    command += struct.pack('>f', gps_offset[1])
-    command += struct.pack('>f', gps_offset[2])
-    command += fletcher_checksum(command)
-    imu.write(command)
-    #Configure UART
-    imu.write(bytes([0x75, 0x65, 0x0C, 0x07, 0x07, 0x41, 0x01, 0x02, 0x05, 0x22, 0x00, 0x5F, 0xB4]))
-    imu.write(bytes([0x75, 0x65, 0x01, 0x08, 0x08, 0x09, 0x01, 0x02, 0x00, 0x01, 0xC2, 0x00, 0xBA, 0x3B]))
-    time.sleep(0.25)
+    check_commands(send_mip_commands(imu, [
+        ("GNSS antenna offset", mip_packet(0x0D, 0x13, bytes([0x01]) + struct.pack('>fff', *gps_offset))),
+        # Configure UART
+        ("GPIO2 UART", mip_packet(0x0C, 0x41, bytes([0x01, 0x02, 0x05, 0x22, 0x00]))),
+        ("UART2 baud rate 115200", mip_packet(0x01, 0x09, bytes([0x01, 0x02]) + struct.pack('>I', 115200))),
+    ], log), "GPS", log)
     print("GPS initialized successfully")
-    log.write("GPS initialized sucessfully") 
+    log.write("GPS initialized sucessfully\n")
 
-def initialize_stream(imu, log, decimation):
+def initialize_stream(imu, log, imu_stream = DEFAULT_STREAM):
     """
-    Initialize stream of timestamps and acceleration data
+    Initialize stream of timestamps and the sensor fields in imu_stream (see stream_spec)
     """
-    
-    command = bytes([0x75, 0x65, 0x0C, 0x0B, 0x0B, 0x0F, 0x01, 0x80, 0x02, 0xD3, 0x00, decimation, 0x04, 0x00, decimation])
-    command += fletcher_checksum(command)
-    imu.write(command)
-    imu.write(bytes([0x75, 0x65, 0x0C, 0x05, 0x05, 0x0F, 0x01, 0x82, 0x00, 0x82, 0x13]))
-    imu.write(bytes([0x75, 0x65, 0x0C, 0x05, 0x05, 0x0F, 0x01, 0x94, 0x00, 0x94, 0x37]))
-    imu.write(bytes([0x75, 0x65, 0x0C, 0x05, 0x05, 0x0F, 0x01, 0xA0, 0x00, 0xA0, 0x4F]))
-    imu.write(bytes([0x75, 0x65, 0x13, 0x04, 0x04, 0x1F, 0x01, 0x01, 0x16, 0x61]))
-    time.sleep(0.25)
+    needed = check_stream(imu_stream)
+    message = f"IMU stream: {', '.join(f'{name} {rate} Hz' for name, rate in imu_stream)}, {needed:.0f} B/s of {IMU_BAUD // 10} B/s"
+    print(message)
+    log.write(message + "\n")
+    check_commands(send_mip_commands(imu, [
+        ("IMU message format", mip_packet(0x0C, 0x0F, message_format(imu_stream))),
+        ("Disable 0x82 stream", mip_packet(0x0C, 0x0F, bytes([0x01, 0x82, 0x00]))),
+        ("Disable 0x94 stream", mip_packet(0x0C, 0x0F, bytes([0x01, 0x94, 0x00]))),
+        ("Disable 0xA0 stream", mip_packet(0x0C, 0x0F, bytes([0x01, 0xA0, 0x00]))),
+        ("Aiding command 0x13 0x1F", mip_packet(0x13, 0x1F, bytes([0x01, 0x01]))),
+    ], log), "Stream", log)
     print("Stream initialized successfully")
     log.write("Stream initialized successfully\n")
 
     #Resume stream
-    imu.write(bytes([0x75, 0x65, 0x01, 0x02, 0x02, 0x06, 0xE5, 0xCB]))
+    check_commands(send_mip_commands(imu, [("Resume", mip_packet(0x01, 0x06))], log), "Stream", log)
 
-def fletcher_checksum(data):
-    '''
-    Calculate Fletcher checksum for 3DM-CV7-INS
-    data: bytes object containing the message to checksum
-    Returns: 2 bytes checksum
-    '''
-    MSB = 0
-    LSB = 0
-    for byte in data:
-        MSB = (MSB + byte) & 0xFF  # Ensure 8-bit result using & 0xFF
-        LSB = (LSB + MSB) & 0xFF
-    # Return the two checksum bytes
-    return(bytes([MSB, LSB])) 
+def check_commands(failed, what, log):
+    """
+    Raise RuntimeError (after logging it) if any command of a configuration step was not acknowledged
+    """
+    if failed:
+        message = f"{what} configuration failed: {', '.join(failed)} not acknowledged"
+        print(message)
+        log.write(message + "\n")
+        raise RuntimeError(message)
+
+def mip_packet(descriptor_set, field_descriptor, payload = b''):
+    """
+    Build a single-field MIP command packet with its checksum
+    """
+    packet = bytes([0x75, 0x65, descriptor_set, len(payload) + 2, len(payload) + 2, field_descriptor]) + payload
+    return packet + fletcher_checksum(packet)
+
+def mip_acks(reply):
+    """
+    Yield (command descriptor, error code) for every ACK/NACK field (0xF1) in a reply packet
+    """
+    position = 4
+    end = 4 + reply[3]
+    while position + 1 < end and reply[position] >= 2:
+        if reply[position + 1] == 0xF1 and reply[position] >= 4:
+            yield reply[position + 2], reply[position + 3]
+        position += reply[position]
+
+def send_mip_commands(imu, commands, log, window = 4, timeout = 0.25, retries = 3):
+    """
+    Send (name, packet) MIP commands keeping up to window awaiting a reply
+    Each ACK/NACK field is matched to the oldest outstanding command with the same descriptor set
+    and field descriptor; NACKs and timeouts are resent after a backoff of timeout * 2**attempt
+    with a doubled reply timeout, up to retries times
+    Returns the names of the commands that were never acknowledged
+    """
+    framer = MipFramer()
+    queue = deque((name, packet, 0, 0.0) for name, packet in commands)  # (name, packet, attempt, not before)
+    pending = deque()  # (name, packet, attempt, deadline) awaiting a reply
+    failed = []
+
+    def retry(name, packet, attempt, reason):
+        if attempt < retries:
+            print(f"{name}: {reason}, retrying")
+            log.write(f"{name}: {reason}, retrying\n")
+            queue.appendleft((name, packet, attempt + 1, time.monotonic() + timeout * 2 ** attempt))
+        else:
+            print(f"{name}: {reason}, giving up")
+            log.write(f"{name}: {reason}, giving up\n")
+            failed.append(name)
+
+    while queue or pending:
+        burst = []
+        # A command waiting out its backoff holds back the ones queued behind it, keeping their order
+        while queue and len(pending) < window and queue[0][3] <= time.monotonic():
+            name, packet, attempt, ready = queue.popleft()
+            burst.append(packet)
+            pending.append((name, packet, attempt, time.monotonic() + timeout * 2 ** attempt))
+        if burst:
+            imu.write(b"".join(burst))
+        if not pending:
+            # Only backoffs left: wait for the next one rather than block in a read
+            time.sleep(max(0.0, queue[0][3] - time.monotonic()))
+            continue
+
+        framer.feed(imu.read(imu.in_waiting or 1))
+        reply = framer.next_frame()
+        while reply is not None:
+            for command, error in mip_acks(reply):
+                for i, (name, packet, attempt, deadline) in enumerate(pending):
+                    if packet[2] == reply[2] and packet[5] == command:
+                        del pending[i]
+                        if error:
+                            retry(name, packet, attempt, f"NACK 0x{error:02x}")
+                        break
+            reply = framer.next_frame()
+        while pending and time.monotonic() > pending[0][3]:
+            name, packet, attempt, deadline = pending.popleft()
+            retry(name, packet, attempt, "no reply")
+    return failed
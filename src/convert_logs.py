@@ -0,0 +1,168 @@
+import os
+import re
+import glob
+import json
+import hashlib
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+'''
+Bulk converter for the text logs into columnar NumPy files
+
+Each logs/log*.txt becomes <output>/<name>.npz with the columns
+    x, y, z         acceleration in m/s^2 (f8)
+    time_of_week    seconds (f8)
+    week_number     u2
+    difference_ms   'Difference: ... ms' (or '... s') of the PPS test runs, NaN where a line has none
+plus an 'errors' entry (JSON) with the file's line counts: samples, malformed sample
+lines, checksum failures, invalid descriptor sets and the banner/config lines.
+
+Files are converted in parallel and every sample line of a file is matched by one regex
+pass over the whole text. manifest.json in the output directory records each source's
+size, mtime and sha256, so unchanged files are skipped on the next run.
+
+    python convert_logs.py [logs directory or files ...] [--output dir] [--workers n] [--force]
+'''
+
+SAMPLE = re.compile(rb'^Acceleration: X=(\S+), Y=(\S+), Z=(\S+) m/s\^2 (?:.*? )?'
+                    rb'Time of Week: ([^,\s]+), Week Number: (\d+)(?:, Difference: (\S+) (m?)s)?\r?$', re.M)
+SAMPLE_LINE = re.compile(rb'^Acceleration: ', re.M)
+CHECKSUM_LINE = re.compile(rb'^Checksum failed', re.M)
+DESCRIPTOR_LINE = re.compile(rb'^Invalid descriptor set', re.M)
+MANIFEST = 'manifest.json'
+
+def parse_log(data):
+    """
+    Return ({column: array}, error summary) for the bytes of one text log
+    """
+    matches = SAMPLE.findall(data)
+    if matches:
+        values = np.array(matches, dtype=bytes)
+        # Lines without a Difference give b'', which has no float value
+        difference = values[:, 5]
+        difference[difference == b''] = b'nan'
+        columns = {
+            'x': values[:, 0].astype(np.float64),
+            'y': values[:, 1].astype(np.float64),
+            'z': values[:, 2].astype(np.float64),
+            'time_of_week': values[:, 3].astype(np.float64),
+            'week_number': values[:, 4].astype(np.uint16),
+            'difference_ms': difference.astype(np.float64) * np.where(values[:, 6] == b'm', 1.0, 1000.0),
+        }
+    else:
+        columns = {name: np.zeros(0, dtype=np.uint16 if name == 'week_number' else np.float64)
+                   for name in ('x', 'y', 'z', 'time_of_week', 'week_number', 'difference_ms')}
+    sample_lines = len(SAMPLE_LINE.findall(data))
+    checksum_failures = len(CHECKSUM_LINE.findall(data))
+    descriptor_errors = len(DESCRIPTOR_LINE.findall(data))
+    lines = data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
+    errors = {
+        'lines': lines,
+        'samples': len(matches),
+        'malformed': sample_lines - len(matches),
+        'checksum_failures': checksum_failures,
+        'invalid_descriptors': descriptor_errors,
+        'other_lines': lines - sample_lines - checksum_failures - descriptor_errors,
+    }
+    return columns, errors
+
+def convert_file(path, output, sha256):
+    """
+    Convert one log to output (written under a temporary name first) and return its error summary
+    """
+    with open(path, 'rb') as file:
+        columns, errors = parse_log(file.read())
+    if len(columns['time_of_week']):
+        errors['first_time_of_week'] = float(columns['time_of_week'][0])
+        errors['last_time_of_week'] = float(columns['time_of_week'][-1])
+    errors['sha256'] = sha256
+    temporary = output + '.tmp.npz'
+    np.savez(temporary, errors=np.array(json.dumps(errors)), **columns)
+    os.replace(temporary, output)
+    return errors
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def stale(path, output, entry):
+    """
+    None if the existing output is current, else the source's sha256
+    Size and mtime unchanged skip hashing; a touched file with the same content is only hashed
+    """
+    if entry is None or not os.path.exists(output):
+        return file_sha256(path)
+    status = os.stat(path)
+    if entry['size'] == status.st_size and entry['mtime_ns'] == status.st_mtime_ns:
+        return None
+    sha256 = file_sha256(path)
+    if sha256 == entry['sha256']:
+        entry['mtime_ns'] = status.st_mtime_ns
+        return None
+    return sha256
+
+def convert_logs(paths, output_dir, workers = None, force = False):
+    """
+    Convert every stale log in paths; returns {name: error summary} for all of them
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    jobs = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        output = os.path.join(output_dir, name + '.npz')
+        sha256 = file_sha256(path) if force else stale(path, output, manifest.get(name))
+        if sha256 is not None:
+            jobs[name] = (path, output, sha256)
+
+    if jobs:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = {name: pool.submit(convert_file, *job) for name, job in jobs.items()}
+            for name, future in futures.items():
+                path, output, sha256 = jobs[name]
+                status = os.stat(path)
+                manifest[name] = {'source': path, 'size': status.st_size, 'mtime_ns': status.st_mtime_ns,
+                                  'sha256': sha256, 'errors': future.result()}
+    save_manifest(output_dir, manifest)
+    converted = set(jobs)
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    return {name: manifest[name]['errors'] for name in names}, converted
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert text IMU logs to columnar .npz files")
+    parser.add_argument('paths', nargs='*', default=['./logs'], help="log files or directories of log*.txt")
+    parser.add_argument('--output', default='./logs/columnar')
+    parser.add_argument('--workers', type=int, help="processes (default: one per core)")
+    parser.add_argument('--force', action='store_true', help="convert even files the manifest says are current")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.paths:
+        paths += sorted(glob.glob(os.path.join(path, 'log*.txt'))) if os.path.isdir(path) else [path]
+    summaries, converted = convert_logs(paths, args.output, args.workers, args.force)
+    totals = {}
+    for name, errors in summaries.items():
+        for key in ('samples', 'malformed', 'checksum_failures', 'invalid_descriptors'):
+            totals[key] = totals.get(key, 0) + errors[key]
+        if errors['malformed'] or errors['checksum_failures'] or errors['invalid_descriptors']:
+            print(f"{name}: {errors['samples']} samples, {errors['malformed']} malformed, "
+                  f"{errors['checksum_failures']} checksum failures, {errors['invalid_descriptors']} invalid descriptors")
+    print(f"{len(paths)} logs ({len(converted)} converted, {len(paths) - len(converted)} current): "
+          + ", ".join(f"{key}={value}" for key, value in totals.items()))
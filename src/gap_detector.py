@@ -0,0 +1,154 @@
+import sys
+import json
+import numpy as np
+from time_align import SECONDS_PER_WEEK, load_imu
+
+'''
+Dropout detection from the IMU GPS timestamps
+
+Consecutive timestamped packets should be one sample interval apart (the period of the
+fastest field in the stream spec). A step of more than 1 + TOLERANCE intervals is a run of
+missing samples, round(step / interval) - 1 long; a step backwards is counted as out of
+order, and a step over MAX_JUMP seconds (such as the receiver's first GPS fix replacing the
+free-running clock) as a time jump rather than as missing samples. Weeks are folded into
+the timestamps, so week rollover is just another step.
+
+GapDetector checks samples online; find_gaps gives the same report for stored data.
+
+    python gap_detector.py <imu .bin or .index, or a convert_logs .npz> [interval in s]
+'''
+
+TOLERANCE = 0.5
+MAX_JUMP = 60.0 # s
+MAX_LISTED = 1000 # gap runs listed individually in a report
+
+class GapDetector:
+    """
+    Tracks expected against observed sample intervals as samples arrive
+    log: optional file each missing-sample run is written to
+    """
+    def __init__(self, interval, log = None, tolerance = TOLERANCE, max_jump = MAX_JUMP):
+        self.interval = interval
+        self.log = log
+        self.limit = interval * (1 + tolerance)
+        self.max_jump = max_jump
+        self.first = None
+        self.last = None
+        self.last_time = None
+        self.samples = 0
+        self.missing = 0
+        self.runs = 0
+        self.longest_run = 0
+        self.out_of_order = 0
+        self.time_jumps = 0
+        self.gaps = []
+
+    def update(self, week, time_of_week):
+        self.samples += 1
+        time = week * SECONDS_PER_WEEK + time_of_week
+        if self.last_time is None:
+            self.first = (week, time_of_week)
+        else:
+            step = time - self.last_time
+            if step <= 0:
+                self.out_of_order += 1
+                return
+            if step > self.max_jump:
+                self.time_jumps += 1
+            elif step > self.limit:
+                self.gap(round(step / self.interval) - 1)
+        self.last_time = time
+        self.last = (week, time_of_week)
+
+    def gap(self, missing):
+        self.missing += missing
+        self.runs += 1
+        self.longest_run = max(self.longest_run, missing)
+        if len(self.gaps) < MAX_LISTED:
+            self.gaps.append([int(self.last[0]), self.last[1], missing])
+        if self.log:
+            self.log.write(f"IMU gap: {missing} samples missing after week {self.last[0]} TOW {self.last[1]:.6f}\n")
+
+    def report(self):
+        return build_report(self.interval, self.samples, self.first, self.last, self.missing, self.runs,
+                            self.longest_run, self.out_of_order, self.time_jumps, self.gaps)
+
+    def summary(self):
+        report = self.report()
+        return (f"{report['samples']} samples, {report['missing']} missing in {report['runs']} runs "
+                f"(longest {report['longest_run']}), {report['completeness'] * 100:.3f}% complete, "
+                f"{report['out_of_order']} out of order, {report['time_jumps']} time jumps")
+
+    def write_report(self, path):
+        """
+        Save the completeness report as JSON
+        """
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=1)
+
+def build_report(interval, samples, first, last, missing, runs, longest_run, out_of_order, time_jumps, gaps):
+    expected = samples - out_of_order + missing
+    return {
+        'interval': interval,
+        'samples': samples,
+        'first': first,
+        'last': last,
+        'expected': expected,
+        'missing': missing,
+        'runs': runs,
+        'longest_run': longest_run,
+        'out_of_order': out_of_order,
+        'time_jumps': time_jumps,
+        'completeness': (samples - out_of_order) / expected if expected else 1.0,
+        'gaps': gaps,
+    }
+
+def find_gaps(week, time_of_week, interval, tolerance = TOLERANCE, max_jump = MAX_JUMP):
+    """
+    GapDetector's report for whole arrays of timestamps at once
+    """
+    week = np.asarray(week, dtype=np.int64)
+    time_of_week = np.asarray(time_of_week, dtype=np.float64)
+    if not len(week):
+        return build_report(interval, 0, None, None, 0, 0, 0, 0, 0, [])
+    reference_week = int(week.min())
+    time = (week - reference_week) * SECONDS_PER_WEEK + time_of_week
+    # Out-of-order samples are skipped, so each step is measured from the latest time so far
+    latest = np.maximum.accumulate(time)
+    step = time[1:] - latest[:-1]
+    forward = step > 0
+    jumps = forward & (step > max_jump)
+    gap = forward & ~jumps & (step > interval * (1 + tolerance))
+    missing = np.rint(step[gap] / interval).astype(np.int64) - 1
+    # Index of the sample that set the latest time, i.e. the one each gap follows
+    setter = np.maximum.accumulate(np.where(time == latest, np.arange(len(time)), 0))
+    before = setter[:-1][gap]
+    gaps = [[int(week[index]), float(time_of_week[index]), int(count)]
+            for index, count in zip(before[:MAX_LISTED], missing[:MAX_LISTED])]
+    last = int(setter[-1])
+    return build_report(interval, len(time), (int(week[0]), float(time_of_week[0])), (int(week[last]), float(time_of_week[last])),
+                        int(missing.sum()), len(missing), int(missing.max()) if len(missing) else 0,
+                        int(np.count_nonzero(~forward)), int(np.count_nonzero(jumps)), gaps)
+
+def load_timestamps(path):
+    """
+    (week, time_of_week) of a sample log, a run's .index, or a convert_logs .npz
+    """
+    if path.endswith('.npz'):
+        data = np.load(path)
+        return data['week_number'], data['time_of_week']
+    week, time_of_week, columns = load_imu(path)
+    return week, time_of_week
+
+if __name__ == "__main__":
+    week, time_of_week = load_timestamps(sys.argv[1])
+    if len(sys.argv) > 2:
+        interval = float(sys.argv[2])
+    else:
+        # Most common step, so archived logs need no stream spec
+        steps = np.diff(np.asarray(time_of_week, dtype=np.float64))
+        interval = float(np.median(steps[steps > 0])) if np.any(steps > 0) else 0.001
+    report = find_gaps(week, time_of_week, interval)
+    print(json.dumps({key: value for key, value in report.items() if key != 'gaps'}))
+    for gap_week, gap_tow, missing in report['gaps'][:20]:
+        print(f"  {missing} missing after week {gap_week} TOW {gap_tow:.6f}")
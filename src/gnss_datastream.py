@@ -1,23 +1,55 @@
 import serial
 import time
+import struct
+import threading
 from datetime import datetime
+from checksum import fletcher_checksum
+from segment_writer import SegmentWriter
+from metrics import StreamMetrics, MeteredPort
+from publisher import Publisher
+
+UBX_SYNC = bytes([0xB5, 0x62])
+# Largest message the receiver is set up to send: RXM-RAWX with 255 measurements
+# (16 byte header + 32 bytes per measurement, plus sync, class, id, length and checksum)
+MAX_UBX_FRAME = 16 + 32 * 255 + 8
 
 def main(gnss_port = '/dev/ttyACM0',
-         log_file = 'log.txt'):
+         log_file = 'log.txt',
+         stop_event = None,
+         health = None,
+         max_bytes = 64 << 20,
+         max_seconds = 3600,
+         gnss_baud = 9600,
+         publish = None,
+         debug = False):
     
-    gnss = initialize_gnss(log_file, gnss_port)
+    if stop_event is None:
+        stop_event = threading.Event()
+    metrics = StreamMetrics('GNSS')
+    gnss = MeteredPort(initialize_gnss(log_file, gnss_port, gnss_baud), metrics)
+    if health:
+        health.metrics = metrics
+    rawx = None
+    publisher = Publisher(**publish) if publish else None
     try:
-        rawx = open("./rawx/rawx" + log_file[10:-4] + ".ubx", "wb")
-        read_gnss(gnss, rawx)
+        rawx = SegmentWriter("./rawx/rawx" + log_file[10:-4], ".ubx", max_bytes = max_bytes, max_seconds = max_seconds)
+        read_gnss(gnss, rawx, stop_event, health, metrics, publisher, debug)
     except KeyboardInterrupt:
         pass
     finally:
         gnss.close()
+        if rawx:
+            rawx.close()
+        if publisher:
+            publisher.close()
 
-def initialize_gnss(log, gnss_port):
+def initialize_gnss(log, gnss_port, baud = 9600):
+    """
+    Open the receiver port at the rate configuration.configure_gnss left UART1 on (ignored over USB)
+    """
     gnss = serial.Serial(
         port=gnss_port,
-        baudrate=9600, 
+        baudrate=baud, 
         timeout=1)
     
     # Clear any leftover data
@@ -26,38 +58,141 @@ def initialize_gnss(log, gnss_port):
     
     return gnss
 
-def read_gnss(gnss, rawx):
-    data = b''
-    while True:
-        data += gnss.read()
-        if data[-2:] == b'\xb5\x62' and data != b'\xb5\x62':
-            data = data[:-2]
-            if packet_validation(data, rawx):
-                print(data)
-                rawx.write(data)
-            data = b'\xb5\x62'
-        
-def packet_validation(data, rawx):
-    if data[0:2] != b'\xb5\x62':
-        print("Invalid packet header: " + str(data[0:2]))
-        return False
-    if fletcher_checksum(data[2:-2]) != data[-2:]:
-        print("Invalid checksum, expected: " + str(fletcher_checksum(data[2:-2])) + " but got: " + str(data[-2:]))
-        return False
-    if data[3] == b'\x05':
-        return False
-    return True
-
-def fletcher_checksum(data):
-    '''
-    Calculate Fletcher checksum for 3DM-CV7-INS
-    data: bytes object containing the message to checksum
-    Returns: 2 bytes checksum
-    '''
-    MSB = 0
-    LSB = 0
-    for byte in data:
-        MSB = (MSB + byte) & 0xFF  # Ensure 8-bit result using & 0xFF
-        LSB = (LSB + MSB) & 0xFF
-    # Return the two checksum bytes
-    return(bytes([MSB, LSB])) 
+def read_gnss(gnss, rawx, stop_event = None, health = None, metrics = None, publisher = None, debug = False):
+    """
+    Frame and store UBX messages until stopped; debug also prints a line per message
+    """
+    framer = UbxFramer()
+    if metrics is None:
+        metrics = StreamMetrics('GNSS')
+    metrics.framer = framer
+    clock = time.perf_counter_ns
+    while not (stop_event and stop_event.is_set()):
+        failures = framer.checksum_failures
+        if not framer.fill(gnss):
+            continue
+        start = clock()
+        write_time = 0
+        published = []
+        for frame in framer.frames():
+            before = clock()
+            if debug:
+                print(f"UBX 0x{frame[2]:02x} 0x{frame[3]:02x} ({len(frame)} bytes)")
+            rawx.write(frame, rawx_time(frame))
+            if publisher:
+                # Frames are views into the framer buffer, so copy them before the next read
+                published.append(bytes(frame))
+            elapsed = clock() - before
+            metrics.write.record(elapsed)
+            write_time += elapsed
+            if health:
+                health.packet()
+        if published:
+            publisher.publish_frames(published)
+        # Framing and checksums for everything this read delivered
+        metrics.parse.record(clock() - start - write_time)
+        if framer.checksum_failures != failures:
+            print(framer.last_error)
+            if health:
+                health.error()
+
+def rawx_time(frame):
+    """
+    (week, rcvTow) of an RXM-RAWX message, None for any other message
+    """
+    if frame[2] == 0x02 and frame[3] == 0x15 and len(frame) >= 24:
+        tow, week = struct.unpack_from('<dH', frame, 6)
+        return (week, tow)
+    return None
+
+class UbxFramer:
+    """
+    Incremental UBX framer over a fixed bytearray
+    Messages are cut by their length field rather than by the next b5 62 pair, which may
+    appear inside a payload, and are handed out as memoryview slices of the buffer
+    """
+    def __init__(self, size = 0x10000 + 8):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.frames_out = 0
+        self.checksum_failures = 0
+        self.bytes_discarded = 0
+        self.resyncs = 0
+        self.last_error = None
+
+    def reserve(self, wanted):
+        """
+        Return a writable slice of the buffer for up to wanted bytes
+        Slices returned by frames() are only valid until the next reserve
+        """
+        if self.start:
+            # Slide the unconsumed tail to the front; the size never changes so the view stays valid
+            remaining = self.end - self.start
+            self.buffer[:remaining] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+        if self.end == len(self.buffer):
+            # A full buffer without a complete frame cannot be valid data
+            self.bytes_discarded += self.end
+            self.end = 0
+        return self.view[self.end:self.end + max(1, min(wanted, len(self.buffer) - self.end))]
+
+    def fill(self, gnss):
+        """
+        Read everything the port has waiting (at least one byte so the timeout still applies)
+        """
+        count = gnss.readinto(self.reserve(gnss.in_waiting)) or 0
+        self.end += count
+        return count
+
+    def feed(self, data):
+        """
+        Append bytes that were read elsewhere; returns how many fitted
+        """
+        target = self.reserve(len(data))
+        count = min(len(target), len(data))
+        target[:count] = data[:count]
+        self.end += count
+        return count
+
+    def frames(self):
+        """
+        Yield every complete, checksum-valid message currently buffered
+        """
+        buffer = self.buffer
+        while True:
+            start = buffer.find(UBX_SYNC, self.start, self.end)
+            if start < 0:
+                # Keep a trailing 0xb5 in case it is the first half of a header
+                keep = 1 if self.end > self.start and buffer[self.end - 1] == UBX_SYNC[0] else 0
+                self.bytes_discarded += self.end - self.start - keep
+                self.start = self.end - keep
+                return
+            if start > self.start:
+                # Found a header again after skipping bytes
+                self.resyncs += 1
+                self.bytes_discarded += start - self.start
+            self.start = start
+            if self.end - start < 6:
+                return
+            end = start + 6 + (buffer[start + 4] | buffer[start + 5] << 8) + 2
+            if end - start > MAX_UBX_FRAME:
+                # Longer than any message we receive, so this was a false header inside other data;
+                # waiting for that many bytes would stall framing for seconds
+                self.bytes_discarded += 1
+                self.start = start + 1
+                continue
+            if self.end < end:
+                return
+            checksum = fletcher_checksum(self.view[start + 2:end - 2])
+            if self.view[end - 2:end] != checksum:
+                self.checksum_failures += 1
+                self.last_error = "Invalid checksum, expected: " + str(checksum) + " but got: " + str(bytes(self.view[end - 2:end]))
+                self.bytes_discarded += 1
+                self.start = start + 1
+                continue
+            self.start = end
+            self.frames_out += 1
+            yield self.view[start:end]
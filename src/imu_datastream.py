@@ -1,29 +1,169 @@
 import serial
 import time
 import struct
+import threading
 from datetime import datetime
+import numpy as np
+from checksum import fletcher_checksum, validate_frames
+from imu_log import SampleLog
+from write_queue import WriteQueue, SharedLog
+from publisher import Publisher
+from gap_detector import GapDetector
+from metrics import StreamMetrics, MeteredPort
+from stream_spec import SENSOR_FIELDS, FIELD_NAMES, FORMAT_SIZES, field_size, sample_interval
 
+MIP_SYNC = bytes([0x75, 0x65])
+FIELD_SIZES = {descriptor: field_size(name) for descriptor, name in FIELD_NAMES.items()}
+PACKET_DTYPES = {}
 
+def packet_dtype(descriptors):
+    """
+    NumPy dtype of a 0x80 packet holding the given fields in order, built once per layout
+    """
+    dtype = PACKET_DTYPES.get(descriptors)
+    if dtype is None:
+        fields = [('header', 'u1', 4)]
+        for descriptor in descriptors:
+            name = FIELD_NAMES[descriptor]
+            fields.append((name + '_field', 'u1', 2))
+            fields += SENSOR_FIELDS[name][1]
+        fields.append(('checksum', 'u1', 2))
+        dtype = PACKET_DTYPES[descriptors] = np.dtype(fields)
+    return dtype
+
+PACKET_STRUCTS = {}
+STRUCT_FORMATS = {'f8': 'd', 'f4': 'f', 'u2': 'H'}
+
+def packet_struct(descriptors):
+    """
+    (struct.Struct, [(column, scale)]) of a 0x80 packet, for decoding one packet without NumPy
+    Headers, checksum and valid flags are skipped as padding; built once per layout
+    """
+    layout = PACKET_STRUCTS.get(descriptors)
+    if layout is None:
+        fmt = '>4x'
+        columns = []
+        for descriptor in descriptors:
+            name = FIELD_NAMES[descriptor]
+            fmt += '2x'
+            for column, field_fmt in SENSOR_FIELDS[name][1]:
+                if column == 'valid_flags':
+                    fmt += f'{FORMAT_SIZES[field_fmt[1:]]}x'
+                    continue
+                fmt += STRUCT_FORMATS[field_fmt[1:]]
+                columns.append((column, SENSOR_FIELDS[name][2]))
+        layout = PACKET_STRUCTS[descriptors] = (struct.Struct(fmt + '2x'), columns)
+    return layout
+
+# Default 0x80 packet: header + GPS timestamp field (0xD3) + scaled accel field (0x04) + checksum
+DEFAULT_DESCRIPTORS = (0xD3, 0x04)
+PACKET_DTYPE = packet_dtype(DEFAULT_DESCRIPTORS)
+PACKET_SIZE = PACKET_DTYPE.itemsize
 
 def main(imu_port = '/dev/ttyS0',
-         log_file = 'log.txt'):
+         log_file = 'log.txt',
+         stop_event = None,
+         health = None,
+         sample_prefix = 'imu',
+         sensor_config = None,
+         text_log = False,
+         max_bytes = 64 << 20,
+         max_seconds = 3600,
+         debug = False,
+         status_interval = 1.0,
+         raw_capture = False,
+         decode = True,
+         publish = None):
     
-    log = start_log(log_file)
+    if stop_event is None:
+        stop_event = threading.Event()
+    # The reader logs framing errors while the writer thread logs samples and gaps
+    log = SharedLog(start_log(log_file))
     imu = initialize_imu(log, imu_port)
+    if raw_capture:
+        # Imported here because imu_raw builds on this module
+        from imu_raw import RawCapture
+        # Its own segments and index, so read_run on the sample log only ever sees .bin files
+        raw = imu = RawCapture(imu, sample_prefix + "_raw", sensor_config, max_bytes, max_seconds)
+    samples = SampleLog(sample_prefix, sensor_config, max_bytes, max_seconds)
+    # publish: Publisher arguments (multicast / socket_dir) to also send every batch to local subscribers
+    publisher = Publisher(stream=(sensor_config or {}).get('stream'), **publish) if publish else None
+    gaps = GapDetector(sample_interval((sensor_config or {}).get('stream')), log)
+
+    framer = MipFramer()
+    metrics = StreamMetrics('IMU', framer)
+    imu = MeteredPort(imu, metrics)
+    if health:
+        health.metrics = metrics
+
+    def write_batch(batch):
+        lines = []
+        for data in batch:
+            samples.write(data)
+            gaps.update(data['week_number'], data['time_of_week'])
+            if debug or text_log:
+                message = format_sample(data)
+                if debug:
+                    print(message)
+                if text_log:
+                    lines.append(message + '\n')
+        if lines:
+            log.write(''.join(lines))
+        if publisher:
+            publisher.publish_samples(batch)
+        if not debug:
+            status.update(samples.samples, batch[-1])
+
+    def flush():
+        samples.flush()
+        log.flush()
+
+    # The reader only frames and decodes; printing and disk writes happen on the writer thread
+    queue = WriteQueue(write_batch, flush, name='IMU writer', latency=metrics.write)
+    status = ConsoleStatus(framer, queue, status_interval)
+    if health:
+        health.queue = queue
     try:
-        sync_stream(imu, log)
+        sync_stream(imu, log, framer)
+        # Raw only: no framing at all, every byte goes straight to the capture for offline decoding
+        while not decode and not stop_event.is_set():
+            if imu.read(imu.in_waiting or 1) and health:
+                health.packet()
         # Continuous reading loop
-        while True:
-            data = read_stream_data(imu, log)
-            if data:  # Only print if we got valid data
-                message = f"Acceleration: X={data['x']:.6f}, Y={data['y']:.6f}, Z={data['z']:.6f} m/s^2 Time of Week: {data['time_of_week']:.6f}, Week Number: {data['week_number']}"
-                print(message)
-                log.write(message + '\n')
+        clock = time.perf_counter_ns
+        while not stop_event.is_set():
+            start = clock()
+            read_time = metrics.read.total
+            data = read_stream_data(imu, log, framer, stop_event, debug)
+            if data:
+                # Everything but the serial reads: framing, validation and decoding
+                metrics.parse.record(clock() - start - (metrics.read.total - read_time))
+                queue.put(data)
+                if health:
+                    health.packet()
+            elif not stop_event.is_set():
+                metrics.descriptor_failures += 1
+                if health:
+                    health.error()
     except KeyboardInterrupt:
         print("\nExiting IMU...")
         log.write("\nExiting IMU...\n")
     finally:
         imu.close()
+        queue.close()
+        samples.close()
+        if publisher:
+            publisher.close()
+        log.write(f"{samples.samples} samples written to {sample_prefix}_*.bin\n")
+        if decode:
+            gaps.write_report(sample_prefix + "_gaps.json")
+            log.write(f"IMU completeness: {gaps.summary()}\n")
+        if raw_capture:
+            log.write(f"{raw.bytes} bytes in {raw.chunks} reads captured to {sample_prefix}_raw_*.raw\n")
+            if raw.queue.dropped:
+                log.write(f"{raw.queue.dropped} raw reads dropped with the writer queue full\n")
+        if queue.dropped:
+            log.write(f"{queue.dropped} samples dropped with the writer queue full\n")
         log.close()
         
 ########################################################################## functions ##########################################################################
@@ -46,103 +186,226 @@ def initialize_imu(log, imu_port):
     )
     return imu
 
-def sync_stream(imu, log):
+def sync_stream(imu, log, framer):
     """
-    Sync stream by purging until header is found
+    Purge stale input so framing starts on fresh data
     """
     time.sleep(0.5)
     imu.reset_input_buffer()
     imu.reset_output_buffer()
-    while True:
-        data = imu.read(1)
-        if data == bytes([0x75]):
-            if imu.read(1) == bytes([0x65]):
-                imu.read(32)
-                break
+    framer.reset()
     print("Stream synced")
     log.write("Stream synced\n")
-    pass
 
-def read_stream_data(imu, log):
+def read_stream_data(imu, log, framer, stop_event = None, debug = False):
     """
-    Read stream data from IMU and checks the validity of the data
+    Read the next frame from the IMU and checks the validity of the data
+    Failures are only logged unless debug is set; during an error storm printing each one
+    would hold up the reader, and ConsoleStatus already shows the counts
+    """
+    failures = framer.checksum_failures
+    raw_data = framer.next_frame()
+    while raw_data is None:
+        if stop_event and stop_event.is_set():
+            return None
+        # Read whatever has arrived (at least one byte so the timeout still applies)
+        framer.feed(imu.read(imu.in_waiting or 1))
+        raw_data = framer.next_frame()
+
+    # Report any frames the framer skipped for a bad checksum
+    if framer.checksum_failures != failures:
+        if debug:
+            print(framer.last_error)
+        log.write(framer.last_error + '\n')
+    return decode_frame(raw_data, log, debug)
+
+def decode_frame(raw_data, log, debug = False):
+    """
+    Validate a framed packet and decode it, None (logged, and printed with debug) if it is not a usable data packet
     """
-    # Wait for minimum response size with timeout
-    raw_data = imu.read(34)
-    
-    # Validate checksum
-    if raw_data[32:] != fletcher_checksum(raw_data[0:32]):
-        print(f'Checksum failed. Expected: {fletcher_checksum(raw_data[0:32]).hex()}, Got: {raw_data[32:].hex()}')
-        log.write(f'Checksum failed. Expected: {fletcher_checksum(raw_data[0:32]).hex()}, Got: {raw_data[32:].hex()}\n')
-        sync_stream(imu,log)
-        return None
-        
     # Validate packet type
     if raw_data[2] != 0x80:
-        print(f'Invalid descriptor set: 0x{raw_data[2]:02x}')
+        if debug:
+            print(f'Invalid descriptor set: 0x{raw_data[2]:02x}')
         log.write(f'Invalid descriptor set: 0x{raw_data[2]:02x}\n')
         return None
-        
-    # Validate field descriptor
-    if raw_data[5] != 0xD3 or raw_data[19] != 0x04:
-        print(f'Invalid field descriptor: 0x{raw_data[5]:02x} or 0x{raw_data[19]:02x}')
-        log.write(f'Invalid field descriptor: 0x{raw_data[5]:02x} or 0x{raw_data[19]:02x}\n')
-        return None
-        
-    # Verify header
-    if raw_data[0:2] != bytes([0x75, 0x65]):
-        print(f"Invalid header: {raw_data[0:2]}")
-        log.write(f"Invalid header: {raw_data[0:2]}\n")
+
+    # Validate the field layout; slower fields only appear in some packets
+    descriptors = field_descriptors(raw_data)
+    if descriptors is None or descriptors[0] != 0xD3:
+        fields = ' '.join(f'0x{byte:02x}' for byte in raw_data[4:-2])
+        if debug:
+            print(f'Invalid field layout: {fields}')
+        log.write(f'Invalid field layout: {fields}\n')
         return None
     
-    return parse_stream_data(raw_data, log)
+    return parse_stream_data(raw_data, log, descriptors)
 
-def parse_stream_data(raw_data, log):
+def field_descriptors(raw_data):
+    """
+    Walk the fields of a packet and return their descriptors, or None if any is unknown or the wrong size
+    """
+    descriptors = []
+    position = 4
+    end = len(raw_data) - 2
+    while position < end:
+        length = raw_data[position]
+        if FIELD_SIZES.get(raw_data[position + 1]) != length:
+            return None
+        descriptors.append(raw_data[position + 1])
+        position += length
+    return tuple(descriptors) if descriptors and position == end else None
+
+def parse_stream_data(raw_data, log, descriptors = DEFAULT_DESCRIPTORS):
     '''
-    Parse timestamp and acceleration data from the stream returning a dictionary with all the values
+    Parse timestamp and sensor data from the stream returning a dictionary with all the values
+    One packet at a time goes through struct; decode_packets is the batch path
     '''
+    packet, columns = packet_struct(descriptors)
     try:
         # Check if we have enough data
-        if len(raw_data) < 34:
+        if len(raw_data) < packet.size:
             print(f"Not enough data: {len(raw_data)} bytes")
             return None
-            
-            
-        gps_data = raw_data[6:18]
-        time_of_week = struct.unpack('>d', raw_data[6:14])[0]
-        week_number = struct.unpack('>H', raw_data[14:16])[0]
-
 
-        accel_data = raw_data[20:32]
-        accel_x, accel_y, accel_z = struct.unpack('>fff', accel_data)
-        
-        accel_x = accel_x * 9.80665
-        accel_y = accel_y * 9.80665
-        accel_z = accel_z * 9.80665
-
-        # Convert acceleration data to m/s^2
-        return {
-            'time_of_week': time_of_week,
-            'week_number': week_number,
-            'x': accel_x,
-            'y': accel_y,
-            'z': accel_z
-        }
+        values = packet.unpack_from(raw_data)
+        return {column: value * scale if scale else value for (column, scale), value in zip(columns, values)}
     except Exception as e:
         print(f"Error parsing data: {e}")
         log.write(f"Error parsing data: {e}\n")
         return None
 
-def fletcher_checksum(data):
+def decode_packets(buffer, count = None, offset = 0, descriptors = DEFAULT_DESCRIPTORS):
     '''
-    Calculate Fletcher checksum for 3DM-CV7-INS
-    data: bytes object containing the message to checksum
-    Returns: 2 bytes checksum
+    Decode back-to-back 0x80 packets with the same field layout in one pass
+    Returns a dictionary of arrays per column with values already converted to SI units
     '''
-    MSB = 0
-    LSB = 0
-    for byte in data:
-        MSB = (MSB + byte) & 0xFF  # Ensure 8-bit result using & 0xFF
-        LSB = (LSB + MSB) & 0xFF
-    # Return the two checksum bytes
-    return(bytes([MSB, LSB])) 
+    dtype = packet_dtype(descriptors)
+    if count is None:
+        count = (len(buffer) - offset) // dtype.itemsize
+    packets = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+    data = {}
+    for descriptor in descriptors:
+        name = FIELD_NAMES[descriptor]
+        columns, scale = SENSOR_FIELDS[name][1], SENSOR_FIELDS[name][2]
+        for column, fmt in columns:
+            if column == 'valid_flags':
+                continue
+            values = packets[column]
+            data[column] = values.astype(np.float64) * scale if scale else values.astype(values.dtype.newbyteorder('='))
+    return data
+
+def valid_packets(buffer, count = None, offset = 0, descriptors = DEFAULT_DESCRIPTORS):
+    '''
+    Boolean mask of the packets in buffer that have a good header, checksum and field layout
+    '''
+    dtype = packet_dtype(descriptors)
+    if count is None:
+        count = (len(buffer) - offset) // dtype.itemsize
+    packets = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+    header = packets['header']
+    valid = (validate_frames(buffer, dtype.itemsize, offset, count)
+             & (header[:, 0] == 0x75) & (header[:, 1] == 0x65) & (header[:, 2] == 0x80))
+    for descriptor in descriptors:
+        field = packets[FIELD_NAMES[descriptor] + '_field']
+        valid &= (field[:, 0] == FIELD_SIZES[descriptor]) & (field[:, 1] == descriptor)
+    return valid
+
+def format_sample(data):
+    """
+    One-line text form of a decoded sample, matching the original acceleration log lines
+    """
+    message = ""
+    if 'x' in data:
+        message = f"Acceleration: X={data['x']:.6f}, Y={data['y']:.6f}, Z={data['z']:.6f} m/s^2 "
+    extra = [f"{key}={value:.6f}" for key, value in data.items() if key not in ('time_of_week', 'week_number', 'x', 'y', 'z')]
+    if extra:
+        message += ", ".join(extra) + " "
+    return message + f"Time of Week: {data['time_of_week']:.6f}, Week Number: {data['week_number']}"
+
+class MipFramer:
+    """
+    Incremental MIP framer over a rolling buffer
+    Frames are cut by the payload-length byte, so packets of any size are handled, and
+    a bad checksum only skips that sync pair instead of the bytes queued behind it
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+        self.frames = 0
+        self.checksum_failures = 0
+        self.bytes_discarded = 0
+        self.resyncs = 0
+        self.last_error = None
+
+    def reset(self):
+        self.buffer.clear()
+        self.position = 0
+
+    def feed(self, data):
+        """
+        Append newly read bytes, dropping anything already consumed
+        """
+        if self.position:
+            del self.buffer[:self.position]
+            self.position = 0
+        self.buffer += data
+
+    def next_frame(self):
+        """
+        Return the next complete, checksum-valid frame or None if more data is needed
+        """
+        buffer = self.buffer
+        while True:
+            start = buffer.find(MIP_SYNC, self.position)
+            if start < 0:
+                # Keep a trailing 0x75 in case it is the first half of a header
+                keep = 1 if len(buffer) > self.position and buffer[-1] == MIP_SYNC[0] else 0
+                self.bytes_discarded += len(buffer) - self.position - keep
+                self.position = len(buffer) - keep
+                return None
+            if start > self.position:
+                # Found a header again after skipping bytes
+                self.resyncs += 1
+                self.bytes_discarded += start - self.position
+            self.position = start
+            if len(buffer) - start < 4:
+                return None
+            end = start + 4 + buffer[start + 3] + 2
+            if len(buffer) < end:
+                return None
+            checksum = fletcher_checksum(buffer[start:end - 2])
+            if buffer[end - 2:end] != checksum:
+                # Resync inside the buffer from the byte after this header
+                self.checksum_failures += 1
+                self.last_error = f'Checksum failed. Expected: {checksum.hex()}, Got: {buffer[end - 2:end].hex()}'
+                self.bytes_discarded += 1
+                self.position = start + 1
+                continue
+            self.position = end
+            self.frames += 1
+            return bytes(buffer[start:end])
+
+class ConsoleStatus:
+    """
+    Console summary of the IMU stream printed at most once per interval,
+    so console cost stays flat as the sample rate goes up
+    """
+    def __init__(self, framer, queue, interval = 1.0):
+        self.framer = framer
+        self.queue = queue
+        self.interval = interval
+        self.last_report = time.monotonic()
+        self.last_count = 0
+
+    def update(self, count, data):
+        now = time.monotonic()
+        elapsed = now - self.last_report
+        if elapsed < self.interval:
+            return
+        rate = (count - self.last_count) / elapsed
+        self.last_report = now
+        self.last_count = count
+        print(f"IMU {rate:6.1f} Hz | X={data.get('x', float('nan')):.4f}, Y={data.get('y', float('nan')):.4f}, Z={data.get('z', float('nan')):.4f} m/s^2 "
+              f"TOW={data['time_of_week']:.3f} | checksum failures={self.framer.checksum_failures}"
+              + (f" queue={len(self.queue.items)}/{self.queue.depth}" if self.queue else ""))
@@ -0,0 +1,128 @@
+import json
+import math
+import struct
+import sys
+from segment_writer import SegmentWriter, read_index
+from stream_spec import sample_columns
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+'''
+Binary IMU sample log
+
+Layout (little-endian):
+    magic       4 bytes  b'IMUL'
+    version     u16
+    header_len  u16      length of the JSON sensor config that follows
+    config      header_len bytes of UTF-8 JSON
+    records     time_of_week f64, week u16, then one f32 per column of the config's
+                'stream' spec (accel x/y/z in m/s^2 when there is none); columns a
+                packet did not carry are NaN
+
+Version 1 logs always hold accel x/y/z and are still readable.
+'''
+
+MAGIC = b'IMUL'
+VERSION = 2
+PREAMBLE = struct.Struct('<4sHH')
+
+def record_struct(columns):
+    return struct.Struct('<dH' + 'f' * len(columns))
+
+def record_dtype(columns):
+    return np.dtype([('time_of_week', '<f8'), ('week_number', '<u2')] + [(column, '<f4') for column in columns])
+
+if np is not None:
+    RECORD_DTYPE = record_dtype(['x', 'y', 'z'])
+
+class SampleLog:
+    """
+    Append-only writer for fixed-size IMU sample records, split into segments
+    prefix_0000.bin, prefix_0001.bin, ... that each carry the header
+    """
+    def __init__(self, prefix, config = None, max_bytes = 64 << 20, max_seconds = 3600):
+        self.prefix = prefix
+        header = json.dumps(config or {}).encode()
+        self.columns = sample_columns((config or {}).get('stream'))
+        self.record = record_struct(self.columns)
+        # Keep segments a whole number of records so none is split across files
+        max_bytes -= (max_bytes - PREAMBLE.size - len(header)) % self.record.size
+        self.writer = SegmentWriter(prefix, '.bin', PREAMBLE.pack(MAGIC, VERSION, len(header)) + header, max_bytes, max_seconds)
+        self.samples = 0
+
+    def write(self, data):
+        self.writer.write(self.record.pack(data['time_of_week'], data['week_number'], *[data.get(column, math.nan) for column in self.columns]),
+                          (data['week_number'], data['time_of_week']))
+        self.samples += 1
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+def read_header(path):
+    """
+    Return (sensor config, byte offset of the first record)
+    """
+    with open(path, 'rb') as file:
+        magic, version, header_len = PREAMBLE.unpack(file.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an IMU sample log")
+        if version not in (1, VERSION):
+            raise ValueError(f"{path} has unsupported version {version}")
+        config = json.loads(file.read(header_len) or b'{}')
+    if version == 1:
+        config.pop('stream', None)
+    return config, PREAMBLE.size + header_len
+
+def read_samples(path):
+    """
+    Memory-map a sample log and return (config, structured array of records)
+    A partially written final record is ignored
+    """
+    if np is None:
+        raise ImportError("reading sample logs requires numpy")
+    config, offset = read_header(path)
+    dtype = record_dtype(sample_columns(config.get('stream')))
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    count = (len(data) - offset) // dtype.itemsize
+    if count == 0:
+        return config, np.zeros(0, dtype=dtype)
+    return config, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+def read_run(index_file):
+    """
+    Read every segment listed in a SampleLog index into one structured array
+    """
+    if np is None:
+        raise ImportError("reading sample logs requires numpy")
+    segments = [read_samples(segment[0]) for segment in read_index(index_file)]
+    if not segments:
+        return {}, np.zeros(0, dtype=RECORD_DTYPE)
+    return segments[0][0], np.concatenate([samples for config, samples in segments])
+
+def export_text(path, text_file):
+    """
+    Write a sample log (a segment, or a whole run given its .index file) out in the text format used by imu_datastream
+    """
+    config, samples = read_run(path) if path.endswith('.index') else read_samples(path)
+    columns = samples.dtype.names
+    with open(text_file, 'w') as out:
+        for sample in samples:
+            # Same line format as imu_datastream.format_sample, leaving out columns this packet did not carry
+            message = ""
+            if 'x' in columns:
+                message = f"Acceleration: X={sample['x']:.6f}, Y={sample['y']:.6f}, Z={sample['z']:.6f} m/s^2 "
+            extra = [f"{column}={sample[column]:.6f}" for column in columns[2:] if column not in ('x', 'y', 'z') and not math.isnan(sample[column])]
+            if extra:
+                message += ", ".join(extra) + " "
+            out.write(message + f"Time of Week: {sample['time_of_week']:.6f}, Week Number: {sample['week_number']}\n")
+    return len(samples)
+
+if __name__ == "__main__":
+    # python imu_log.py <sample log segment or .index> <text file>
+    print(f"Exported {export_text(sys.argv[1], sys.argv[2])} samples")
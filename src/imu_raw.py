@@ -0,0 +1,188 @@
+import json
+import sys
+import time
+import struct
+import numpy as np
+from segment_writer import SegmentWriter, read_index
+from imu_datastream import MipFramer, field_descriptors, decode_packets, packet_dtype, valid_packets
+from imu_log import SampleLog
+from write_queue import WriteQueue
+
+'''
+Raw IMU byte capture
+
+The exact byte stream read from the serial port, split into segments like the sample log.
+Layout (little-endian):
+    magic       4 bytes  b'IMUR'
+    version     u16
+    header_len  u16      length of the JSON sensor config that follows
+    config      header_len bytes of UTF-8 JSON
+    chunks      monotonic_ns u64, length u32, then length bytes as returned by one serial read
+Nothing is framed or checked while capturing; decode_raw does all of that offline.
+A capture has its own segments and .index (prefix_raw_NNNN.raw and prefix_raw.index next
+to a run's sample log), and the chunks are written to disk by a writer thread of their own.
+'''
+
+MAGIC = b'IMUR'
+VERSION = 1
+PREAMBLE = struct.Struct('<4sHH')
+CHUNK = struct.Struct('<QI')
+BATCH_PACKETS = 1 << 16 # packets checked per valid_packets call in decode_raw
+
+class RawCapture:
+    """
+    Wraps a serial port and records every chunk returned by read() before passing it on
+    The reader only queues chunks; buffering, writing and the segment fsyncs happen on the writer thread
+    """
+    def __init__(self, port, prefix, config = None, max_bytes = 64 << 20, max_seconds = 3600):
+        self.port = port
+        header = json.dumps(config or {}).encode()
+        self.writer = SegmentWriter(prefix, '.raw', PREAMBLE.pack(MAGIC, VERSION, len(header)) + header,
+                                    max_bytes, max_seconds, buffer_size = 1 << 20)
+        self.queue = WriteQueue(self.write_batch, name='IMU raw writer')
+        self.chunks = 0
+        self.bytes = 0
+
+    def read(self, size = 1):
+        data = self.port.read(size)
+        if data and self.queue.put(CHUNK.pack(time.monotonic_ns(), len(data)) + data):
+            self.chunks += 1
+            self.bytes += len(data)
+        return data
+
+    def write_batch(self, batch):
+        for chunk in batch:
+            self.writer.write(chunk)
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def close(self):
+        self.port.close()
+        self.queue.close()
+        self.writer.close()
+
+def read_chunks(path):
+    """
+    Return (config, stream bytes, chunk monotonic_ns array, chunk end offsets in the stream)
+    A partially written final chunk is ignored
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    magic, version, header_len = PREAMBLE.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a raw IMU capture")
+    if version != VERSION:
+        raise ValueError(f"{path} has unsupported version {version}")
+    config = json.loads(data[PREAMBLE.size:PREAMBLE.size + header_len] or b'{}')
+    stream = bytearray()
+    times = []
+    ends = []
+    position = PREAMBLE.size + header_len
+    while position + CHUNK.size <= len(data):
+        timestamp, length = CHUNK.unpack_from(data, position)
+        position += CHUNK.size
+        if position + length > len(data):
+            break
+        stream += data[position:position + length]
+        position += length
+        times.append(timestamp)
+        ends.append(len(stream))
+    return config, bytes(stream), np.array(times, dtype=np.uint64), np.array(ends, dtype=np.int64)
+
+def read_raw_run(path):
+    """
+    read_chunks for one segment, or for every segment of a run given its .index file
+    """
+    if not path.endswith('.index'):
+        return read_chunks(path)
+    segments = [read_chunks(segment[0]) for segment in read_index(path)]
+    if not segments:
+        return {}, b'', np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    offsets = np.cumsum([0] + [len(stream) for config, stream, times, ends in segments[:-1]])
+    return (segments[0][0], b''.join(segment[1] for segment in segments),
+            np.concatenate([segment[2] for segment in segments]),
+            np.concatenate([segment[3] + offset for segment, offset in zip(segments, offsets)]))
+
+def decode_raw(path):
+    """
+    Frame and decode a raw capture in batches
+    Each good packet's layout is checked over the aligned run behind it with valid_packets,
+    so a clean stream is framed a batch at a time and the framer only walks damaged stretches
+    Returns (config, {column: array} sorted by arrival, framing statistics); 'arrival_ns' is the
+    monotonic time of the serial read that completed each packet
+    """
+    config, stream, times, ends = read_raw_run(path)
+    framer = MipFramer()
+    framer.feed(stream)
+    layouts = {}
+    invalid = 0
+    while True:
+        frame = framer.next_frame()
+        if frame is None:
+            break
+        descriptors = field_descriptors(frame) if frame[2] == 0x80 else None
+        if descriptors is None or descriptors[0] != 0xD3:
+            invalid += 1
+            continue
+        # The packets behind a good one usually share its layout, so check that run in batches,
+        # starting small so streams that interleave layouts do not pay for a large check per packet
+        size = len(frame)
+        start = framer.position - size
+        batch = 16
+        while True:
+            count = min(batch, (len(stream) - framer.position) // size)
+            if not count:
+                break
+            valid = valid_packets(framer.buffer, count, framer.position, descriptors)
+            run = count if valid.all() else int(np.argmin(valid))
+            framer.position += run * size
+            framer.frames += run
+            if run < count:
+                break
+            batch = min(batch * 4, BATCH_PACKETS)
+        layouts.setdefault(descriptors, []).append((start, (framer.position - start) // size))
+
+    parts = []
+    for descriptors, runs in layouts.items():
+        size = packet_dtype(descriptors).itemsize
+        part = decode_packets(b''.join(stream[start:start + count * size] for start, count in runs), descriptors=descriptors)
+        part['stream_end'] = np.concatenate([start + size * np.arange(1, count + 1, dtype=np.int64) for start, count in runs])
+        parts.append(part)
+    # Columns a layout does not carry are NaN in its rows, then rows go back into stream order
+    names = list(dict.fromkeys(name for part in parts for name in part)) or ['time_of_week', 'week_number', 'stream_end']
+    merged = {name: np.concatenate([part[name] if name in part else np.full(len(part['stream_end']), np.nan) for part in parts])
+              if parts else np.zeros(0) for name in names}
+    order = np.argsort(merged['stream_end'], kind='stable')
+    merged = {name: values[order] for name, values in merged.items()}
+    stream_end = merged.pop('stream_end')
+    merged['arrival_ns'] = times[np.minimum(np.searchsorted(ends, stream_end), len(times) - 1)] if len(times) else np.zeros(0, dtype=np.uint64)
+    statistics = {
+        'bytes': len(stream),
+        'chunks': len(times),
+        'packets': len(stream_end),
+        'invalid_packets': invalid,
+        'checksum_failures': framer.checksum_failures,
+        'bytes_discarded': framer.bytes_discarded,
+    }
+    return config, merged, statistics
+
+def export_samples(path, prefix):
+    """
+    Decode a raw capture into a sample log (prefix_0000.bin, ...) as if it had been decoded live
+    """
+    config, data, statistics = decode_raw(path)
+    samples = SampleLog(prefix, config)
+    columns = [name for name in data if name != 'arrival_ns']
+    for row in zip(*(data[name].tolist() for name in columns)):
+        samples.write(dict(zip(columns, row)))
+    samples.close()
+    return statistics
+
+if __name__ == "__main__":
+    # python imu_raw.py <raw capture segment or .index> [sample log prefix]
+    if len(sys.argv) > 2:
+        statistics = export_samples(sys.argv[1], sys.argv[2])
+    else:
+        statistics = decode_raw(sys.argv[1])[2]
+    print(", ".join(f"{name}={value}" for name, value in statistics.items()))
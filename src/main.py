@@ -2,17 +2,56 @@ from datetime import datetime
 from configuration import main as configuration
 from imu_datastream import main as imu_datastream
 from gnss_datastream import main as gnss_datastream
+from supervisor import run_capture
+from async_capture import run_async_capture
+from multiprocess_capture import run_multiprocess_capture
 
 gnss_port = '/dev/ttyACM0'
 imu_port = '/dev/ttyS0'
+gnss_baud = 115200 # UART1 rate set during configuration (the native USB port ignores it)
 gps_offset = [0.0, 0.0, 0.0] # [x,y,z]m
-decimation = 0x01 # 1/decimation Hz (max 333.333 Hz)
+# IMU fields and rates in Hz (accel, gyro, mag, delta_theta, delta_velocity); rates must divide the 1000 Hz
+# base rate and the GPS timestamp is added at the fastest one. Configuration refuses streams the UART cannot carry
+imu_stream = [('accel', 1000)]
+text_log = False # also write every IMU sample to the text log
+debug = False # print every IMU sample and GNSS message instead of a once-a-second summary
+raw_capture = False # also record the exact IMU byte stream to logs/imu{time-start}_raw_NNNN.raw
+decode_imu = True # with raw_capture, False skips live decoding (decode later with src/imu_raw.py)
+segment_bytes = 64 << 20 # roll IMU and rawx output over to a new file at this size
+segment_seconds = 3600 # ... or after this long
+metrics_address = None # e.g. ('127.0.0.1', 5555) to also send reader metrics snapshots over UDP
+# Publish decoded IMU batches and UBX messages to local subscribers (layout in src/publisher.py), e.g.
+# {'multicast': ('239.255.0.1', 5600)} or {'socket_dir': '/tmp/d300'}; None to only write files
+publish = None
+async_io = False # read both ports from one asyncio event loop instead of a thread each (no raw_capture/text_log/debug)
+processes = False # a reader and a decoder process per port over shared-memory rings, to use every core (same limits)
 
 def main():
     log_file = initalize_log()
-    configuration(imu_port = imu_port, gnss_port = gnss_port, gps_offset = gps_offset, decimation = decimation, log_file = log_file)
-    gnss_datastream(gnss_port = gnss_port, log_file = log_file)
-    imu_datastream(imu_port = imu_port, log_file = log_file)
+    configuration(imu_port = imu_port, gnss_port = gnss_port, gps_offset = gps_offset, imu_stream = imu_stream, log_file = log_file,
+                  gnss_baud = gnss_baud)
+    if processes:
+        run_multiprocess_capture(imu_port = imu_port, gnss_port = gnss_port, log_file = log_file, sample_prefix = "./logs/imu" + log_file[10:-4],
+                                 sensor_config = {'imu_port': imu_port, 'gps_offset': gps_offset, 'stream': imu_stream}, gnss_baud = gnss_baud,
+                                 max_bytes = segment_bytes, max_seconds = segment_seconds, publish = publish)
+        return
+    if async_io:
+        run_async_capture(imu_port = imu_port, gnss_port = gnss_port, log_file = log_file, sample_prefix = "./logs/imu" + log_file[10:-4],
+                          sensor_config = {'imu_port': imu_port, 'gps_offset': gps_offset, 'stream': imu_stream}, gnss_baud = gnss_baud,
+                          max_bytes = segment_bytes, max_seconds = segment_seconds,
+                          metrics_file = "./logs/metrics" + log_file[10:-4] + ".jsonl", metrics_address = metrics_address, publish = publish)
+        return
+    run_capture({
+        'GNSS': lambda stop_event, health: gnss_datastream(gnss_port = gnss_port, log_file = log_file, stop_event = stop_event, health = health,
+                                                           max_bytes = segment_bytes, max_seconds = segment_seconds, gnss_baud = gnss_baud,
+                                                           publish = publish, debug = debug),
+        'IMU': lambda stop_event, health: imu_datastream(imu_port = imu_port, log_file = log_file, stop_event = stop_event, health = health,
+                                                         sample_prefix = "./logs/imu" + log_file[10:-4],
+                                                         sensor_config = {'imu_port': imu_port, 'gps_offset': gps_offset, 'stream': imu_stream},
+                                                         text_log = text_log, max_bytes = segment_bytes, max_seconds = segment_seconds,
+                                                         debug = debug, raw_capture = raw_capture, decode = decode_imu,
+                                                         publish = publish),
+    }, log_file, metrics_file = "./logs/metrics" + log_file[10:-4] + ".jsonl", metrics_address = metrics_address)
 
 def initalize_log():
     log_file = "./logs/log"+ datetime.now().strftime('%Y-%m-%d_%H-%M-%S.%f') +".txt"
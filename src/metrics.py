@@ -0,0 +1,112 @@
+import time
+
+class Histogram:
+    """
+    Latency histogram with power-of-two buckets: bucket i counts latencies under 2**i microseconds
+    Recording is a few integer operations, cheap enough for every packet
+    """
+    def __init__(self, buckets = 24):
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        self.counts[min((ns // 1000).bit_length(), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, percent):
+        """
+        Upper bound (us) of the bucket holding the given percentile
+        """
+        target = self.count * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return 1 << bucket
+        return 0
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean_us': self.total / self.count / 1000 if self.count else 0.0,
+            'p50_us': self.percentile(50),
+            'p99_us': self.percentile(99),
+            'max_us': self.max / 1000,
+            'buckets': {f"<{1 << bucket}us": count for bucket, count in enumerate(self.counts) if count},
+        }
+
+class StreamMetrics:
+    """
+    Per-stage counters and latency histograms for one reader
+    Framing counters are read from the framer itself when a snapshot is taken
+    """
+    def __init__(self, name, framer = None):
+        self.name = name
+        self.framer = framer
+        self.reads = 0
+        self.bytes_in = 0
+        self.in_waiting_max = 0
+        self.descriptor_failures = 0
+        self.read = Histogram()
+        self.parse = Histogram()
+        self.write = Histogram()
+
+    def snapshot(self):
+        framer = self.framer
+        snapshot = {
+            'stream': self.name,
+            'time': time.time(),
+            'reads': self.reads,
+            'bytes_in': self.bytes_in,
+            'in_waiting_max': self.in_waiting_max,
+            'descriptor_failures': self.descriptor_failures,
+        }
+        if framer is not None:
+            snapshot.update({
+                'frames_out': framer.frames_out if hasattr(framer, 'frames_out') else framer.frames,
+                'resyncs': framer.resyncs,
+                'checksum_failures': framer.checksum_failures,
+                'bytes_discarded': framer.bytes_discarded,
+            })
+        snapshot.update({'read': self.read.snapshot(), 'parse': self.parse.snapshot(), 'write': self.write.snapshot()})
+        return snapshot
+
+class MeteredPort:
+    """
+    Serial port wrapper that times reads and tracks the in_waiting high-water mark
+    A high in_waiting_max means the reader fell behind and the UART FIFO was at risk of overrun
+    """
+    def __init__(self, port, metrics):
+        self.port = port
+        self.metrics = metrics
+
+    @property
+    def in_waiting(self):
+        waiting = self.port.in_waiting
+        if waiting > self.metrics.in_waiting_max:
+            self.metrics.in_waiting_max = waiting
+        return waiting
+
+    def read(self, size = 1):
+        start = time.perf_counter_ns()
+        data = self.port.read(size)
+        self.metrics.read.record(time.perf_counter_ns() - start)
+        self.metrics.reads += 1
+        self.metrics.bytes_in += len(data)
+        return data
+
+    def readinto(self, buffer):
+        start = time.perf_counter_ns()
+        count = self.port.readinto(buffer) or 0
+        self.metrics.read.record(time.perf_counter_ns() - start)
+        self.metrics.reads += 1
+        self.metrics.bytes_in += count
+        return count
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
@@ -0,0 +1,208 @@
+import time
+import signal
+import multiprocessing
+from datetime import datetime
+from shm_ring import ShmRing
+from supervisor import StreamHealth, report_health
+from imu_datastream import MipFramer, ConsoleStatus, initialize_imu, sync_stream, decode_frame
+from gnss_datastream import UbxFramer, initialize_gnss, rawx_time
+from segment_writer import SegmentWriter
+from imu_log import SampleLog
+from publisher import Publisher
+from gap_detector import GapDetector
+from stream_spec import sample_interval
+
+'''
+Multi-process capture
+
+Each serial port gets a reader process that only moves bytes from the port into a
+shared-memory ring (shm_ring.ShmRing), and each stream a decoder process that frames,
+validates and writes straight from the ring's memory, so the four stages run on separate
+cores instead of sharing one interpreter lock. Nothing is pickled between processes;
+the parent only reads the ring counters for the health reports.
+'''
+
+def read_port(open_port, ring, stop_event):
+    """
+    Reader process: serial bytes into the ring, as soon as they arrive
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    port = None
+    try:
+        port = open_port()
+        while not stop_event.is_set():
+            data = port.read(port.in_waiting or 1)
+            if data:
+                ring.write(data)
+    finally:
+        if port:
+            port.close()
+        # Also when the port never opened, so the decoder is not left waiting
+        ring.close_producer()
+
+def drain(ring, handle, flush, flush_interval):
+    """
+    Decoder process loop: handle chunks until the reader has closed the ring and its last bytes are consumed
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    last_flush = time.monotonic()
+    while True:
+        # Read closed before consuming, so a chunk written just before it was set is still handled
+        closed = ring.closed
+        ring.consume(handle)
+        if closed and ring.head == ring.tail:
+            break
+        if time.monotonic() - last_flush >= flush_interval:
+            flush()
+            last_flush = time.monotonic()
+
+def decode_imu(ring, stop_event, log_file, sample_prefix, sensor_config, max_bytes, max_seconds, publish,
+               flush_interval = 0.25, status_interval = 1.0):
+    log = open(log_file, 'a')
+    framer = MipFramer()
+    samples = SampleLog(sample_prefix, sensor_config, max_bytes, max_seconds)
+    publisher = Publisher(stream=(sensor_config or {}).get('stream'), **publish) if publish else None
+    status = ConsoleStatus(framer, None, status_interval)
+    gaps = GapDetector(sample_interval((sensor_config or {}).get('stream')), log)
+    batch = []
+
+    def handle(view, timestamp):
+        framer.feed(view)
+        packets = errors = 0
+        while True:
+            failures = framer.checksum_failures
+            raw_data = framer.next_frame()
+            if raw_data is None:
+                break
+            if framer.checksum_failures != failures:
+                log.write(framer.last_error + '\n')
+                errors += framer.checksum_failures - failures
+            data = decode_frame(raw_data, log)
+            if data is None:
+                errors += 1
+                continue
+            samples.write(data)
+            gaps.update(data['week_number'], data['time_of_week'])
+            batch.append(data)
+            packets += 1
+        ring.packets += packets
+        ring.errors += errors
+
+    def flush():
+        if batch:
+            if publisher:
+                publisher.publish_samples(batch)
+            status.update(samples.samples, batch[-1])
+            batch.clear()
+        samples.flush()
+        log.flush()
+
+    try:
+        drain(ring, handle, flush, flush_interval)
+        flush()
+    finally:
+        samples.close()
+        if publisher:
+            publisher.close()
+        log.write(f"{samples.samples} samples written to {sample_prefix}_*.bin\n")
+        gaps.write_report(sample_prefix + "_gaps.json")
+        log.write(f"IMU completeness: {gaps.summary()}\n")
+        log.close()
+
+def decode_gnss(ring, stop_event, log_file, max_bytes, max_seconds, publish, flush_interval = 0.25):
+    framer = UbxFramer()
+    rawx = SegmentWriter("./rawx/rawx" + log_file[10:-4], ".ubx", max_bytes = max_bytes, max_seconds = max_seconds)
+    publisher = Publisher(**publish) if publish else None
+
+    def handle(view, timestamp):
+        failures = framer.checksum_failures
+        framer.feed(view)
+        frames = []
+        packets = 0
+        for frame in framer.frames():
+            rawx.write(frame, rawx_time(frame))
+            if publisher:
+                frames.append(bytes(frame))
+            packets += 1
+        if frames:
+            publisher.publish_frames(frames)
+        ring.packets += packets
+        ring.errors += framer.checksum_failures - failures
+
+    try:
+        drain(ring, handle, rawx.flush, flush_interval)
+    finally:
+        rawx.close()
+        if publisher:
+            publisher.close()
+
+def open_imu(imu_port, log_file):
+    log = open(log_file, 'a')
+    imu = initialize_imu(log, imu_port)
+    sync_stream(imu, log, MipFramer())
+    log.close()
+    return imu
+
+def run_multiprocess_capture(imu_port = '/dev/ttyS0', gnss_port = '/dev/ttyACM0', log_file = 'log.txt', sample_prefix = 'imu',
+                             sensor_config = None, gnss_baud = 9600, max_bytes = 64 << 20, max_seconds = 3600,
+                             report_interval = 10.0, stall_timeout = 5.0, publish = None, slots = 1024):
+    """
+    Capture both streams with a reader and a decoder process each until Ctrl-C
+    """
+    context = multiprocessing.get_context('fork')
+    stop_event = context.Event()
+    rings = {'GNSS': ShmRing(slots, context=context), 'IMU': ShmRing(slots, context=context)}
+    readers = [
+        context.Process(target=read_port, name='GNSS reader', args=(lambda: initialize_gnss(log_file, gnss_port, gnss_baud), rings['GNSS'], stop_event)),
+        context.Process(target=read_port, name='IMU reader', args=(lambda: open_imu(imu_port, log_file), rings['IMU'], stop_event)),
+    ]
+    decoders = [
+        context.Process(target=decode_gnss, name='GNSS decoder', args=(rings['GNSS'], stop_event, log_file, max_bytes, max_seconds, publish)),
+        context.Process(target=decode_imu, name='IMU decoder', args=(rings['IMU'], stop_event, log_file, sample_prefix, sensor_config,
+                                                                     max_bytes, max_seconds, publish)),
+    ]
+    processes = {'GNSS': (readers[0], decoders[0]), 'IMU': (readers[1], decoders[1])}
+    health = {name: StreamHealth(name) for name in rings}
+    for name in rings:
+        health[name].queue = rings[name]
+        health[name].started = time.monotonic()
+        health[name].running = True
+    for process in readers + decoders:
+        process.start()
+
+    def update():
+        # Mirror the ring counters into the health objects the supervisor reports use
+        for name, ring in rings.items():
+            stream = health[name]
+            if ring.packets != stream.packets:
+                stream.packets = ring.packets
+                stream.last_packet = time.monotonic()
+            stream.errors = ring.errors
+            stream.running = all(process.is_alive() for process in processes[name])
+            for process in processes[name]:
+                if process.exitcode:
+                    stream.exception = RuntimeError(f"{process.name} exited with {process.exitcode}")
+
+    try:
+        while any(process.is_alive() for process in readers + decoders):
+            time.sleep(report_interval)
+            update()
+            report_health(health, log_file, stall_timeout)
+    except KeyboardInterrupt:
+        print(f"\nStopping capture at {datetime.now().strftime('%Y-%m-%d_%H-%M-%S.%f')}")
+    finally:
+        stop_event.set()
+        # Readers first so the decoders see every byte that was read
+        for process in readers:
+            process.join()
+        # A reader that was killed never closed its ring
+        for ring in rings.values():
+            ring.close_producer()
+        for process in decoders:
+            process.join()
+        update()
+        report_health(health, log_file, stall_timeout)
+        for ring in rings.values():
+            ring.close()
+            ring.unlink()
+    return health
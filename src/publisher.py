@@ -0,0 +1,176 @@
+import os
+import json
+import glob
+import time
+import errno
+import socket
+import struct
+from stream_spec import sample_columns
+
+'''
+Local publisher for decoded IMU samples and GNSS messages
+
+Every datagram starts with (little-endian)
+    magic       4 bytes  b'D300'
+    version     u8
+    kind        u8       0 = IMU schema, 1 = IMU samples, 2 = UBX messages
+    count       u16      records in this datagram
+    sequence    u32      per-kind counter, so a subscriber can spot lost datagrams
+followed by
+    schema      UTF-8 JSON {"columns": [...], "record": struct format}, sent first and then every second
+    samples     count records in the sample log layout: time_of_week f64, week u16, one f32 per column
+    UBX         count complete UBX frames back to back (each cut by its length field)
+
+Transports, both local-only and free for any number of subscribers:
+    multicast   UDP to a multicast group with TTL 0, so datagrams never leave this host
+    socket_dir  a Unix datagram to every *.sock socket a subscriber has bound in a directory
+Sends never block; datagrams nobody is listening for are dropped.
+'''
+
+MAGIC = b'D300'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHI')
+KIND_SCHEMA = 0
+KIND_IMU = 1
+KIND_UBX = 2
+MAX_DATAGRAM = 60000
+SCHEMA_INTERVAL = 1.0
+
+class Publisher:
+    """
+    Sends batches of samples or UBX frames to local subscribers
+    """
+    def __init__(self, multicast = None, socket_dir = None, stream = None):
+        self.multicast = multicast
+        self.socket_dir = socket_dir
+        self.columns = sample_columns(stream)
+        self.record = struct.Struct('<dH' + 'f' * len(self.columns))
+        self.schema = json.dumps({'columns': ['time_of_week', 'week_number'] + self.columns, 'record': self.record.format}).encode()
+        self.schema_sent = None
+        self.sequence = [0, 0, 0]
+        self.sent = 0
+        self.dropped = 0
+        self.udp = None
+        self.unix = None
+        if multicast:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 0)
+            self.udp.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            self.udp.setblocking(False)
+        if socket_dir:
+            os.makedirs(socket_dir, exist_ok=True)
+            self.unix = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.unix.setblocking(False)
+
+    def send(self, kind, count, payload):
+        datagram = HEADER.pack(MAGIC, VERSION, kind, count, self.sequence[kind]) + payload
+        self.sequence[kind] = (self.sequence[kind] + 1) & 0xFFFFFFFF
+        if self.udp:
+            try:
+                self.udp.sendto(datagram, self.multicast)
+                self.sent += 1
+            except OSError:
+                self.dropped += 1
+        if self.unix:
+            for path in glob.glob(os.path.join(self.socket_dir, '*.sock')):
+                try:
+                    self.unix.sendto(datagram, path)
+                    self.sent += 1
+                except OSError as e:
+                    # A full subscriber or one that has gone away must not stall the capture
+                    if e.errno not in (errno.EAGAIN, errno.ENOBUFS, errno.ECONNREFUSED, errno.ENOENT):
+                        raise
+                    self.dropped += 1
+
+    def publish_samples(self, batch):
+        """
+        Publish decoded IMU samples (dicts as produced by imu_datastream) in as few datagrams as fit
+        """
+        now = time.monotonic()
+        if self.schema_sent is None or now - self.schema_sent >= SCHEMA_INTERVAL:
+            self.send(KIND_SCHEMA, 0, self.schema)
+            self.schema_sent = now
+        per_datagram = (MAX_DATAGRAM - HEADER.size) // self.record.size
+        for start in range(0, len(batch), per_datagram):
+            chunk = batch[start:start + per_datagram]
+            payload = b''.join(self.record.pack(data['time_of_week'], data['week_number'], *[data.get(column, float('nan')) for column in self.columns])
+                               for data in chunk)
+            self.send(KIND_IMU, len(chunk), payload)
+
+    def publish_frames(self, frames):
+        """
+        Publish complete UBX frames
+        """
+        payload = bytearray()
+        count = 0
+        for frame in frames:
+            if count and HEADER.size + len(payload) + len(frame) > MAX_DATAGRAM:
+                self.send(KIND_UBX, count, bytes(payload))
+                payload.clear()
+                count = 0
+            payload += frame
+            count += 1
+        if count:
+            self.send(KIND_UBX, count, bytes(payload))
+
+    def close(self):
+        for sender in (self.udp, self.unix):
+            if sender:
+                sender.close()
+
+class Subscriber:
+    """
+    Receives publisher datagrams; for consumers such as a fusion process, visualiser or recorder
+    """
+    def __init__(self, multicast = None, socket_path = None, timeout = None):
+        self.socket_path = socket_path
+        if multicast:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(('', multicast[1]))
+            membership = socket.inet_aton(multicast[0]) + socket.inet_aton('0.0.0.0')
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.bind(socket_path)
+        self.socket.settimeout(timeout)
+        self.record = None
+        self.columns = None
+        self.expected = {}
+        self.lost = 0
+
+    def receive(self):
+        """
+        Wait for the next datagram and return (kind, records)
+        Samples come back as a list of dicts once a schema has been seen (None before that),
+        UBX messages as a list of frames
+        """
+        datagram = self.socket.recv(1 << 16)
+        magic, version, kind, count, sequence = HEADER.unpack_from(datagram)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a publisher datagram")
+        if kind in self.expected and sequence != self.expected[kind]:
+            self.lost += (sequence - self.expected[kind]) & 0xFFFFFFFF
+        self.expected[kind] = (sequence + 1) & 0xFFFFFFFF
+        payload = memoryview(datagram)[HEADER.size:]
+        if kind == KIND_SCHEMA:
+            schema = json.loads(bytes(payload))
+            self.columns = schema['columns']
+            self.record = struct.Struct(schema['record'])
+            return kind, schema
+        if kind == KIND_IMU:
+            if self.record is None:
+                return kind, None
+            return kind, [dict(zip(self.columns, values)) for values in self.record.iter_unpack(payload)]
+        frames = []
+        position = 0
+        for i in range(count):
+            end = position + 8 + (payload[position + 4] | payload[position + 5] << 8)
+            frames.append(bytes(payload[position:end]))
+            position = end
+        return kind, frames
+
+    def close(self):
+        self.socket.close()
+        if self.socket_path:
+            os.remove(self.socket_path)
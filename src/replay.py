@@ -0,0 +1,179 @@
+import os
+import sys
+import time
+import threading
+import numpy as np
+from segment_writer import read_index
+from supervisor import StreamHealth
+from gnss_datastream import read_gnss
+from imu_datastream import MipFramer, read_stream_data
+from imu_raw import read_chunks
+
+'''
+Replay harness: play captured bytes through the live readers without the hardware
+
+ReplaySerial stands in for serial.Serial, so read_gnss and read_stream_data run unchanged.
+Bytes are released at the link rate times a speed factor (or all at once with speed=None),
+optionally with dropped and corrupted bytes, and the stop event is set once the capture runs out.
+
+    python replay.py gnss <rawx .ubx or .index> [speed|max] [drop rate] [corrupt rate]
+    python replay.py imu <raw IMU capture (.raw or .index) or byte dump> [speed|max] [drop rate] [corrupt rate]
+'''
+
+class ReplaySerial:
+    """
+    Read side of serial.Serial over a captured byte stream
+    speed: multiple of real time at baudrate, None to hand bytes over as fast as they are read
+    drop_rate / corrupt_rate: chance of each byte being lost or replaced by a different value
+    """
+    def __init__(self, data, baudrate = 460800, speed = 1.0, drop_rate = 0.0, corrupt_rate = 0.0,
+                 seed = 0, timeout = 1, stop_event = None, port = 'replay'):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.speed = speed
+        self.stop_event = stop_event
+        self.data, self.dropped, self.corrupted = damage(data, drop_rate, corrupt_rate, seed)
+        self.position = 0
+        self.started = None
+
+    def arrived(self):
+        """
+        Bytes of the capture that have 'arrived' on the link so far
+        """
+        if self.speed is None:
+            return len(self.data)
+        if self.started is None:
+            self.started = time.monotonic()
+        return min(len(self.data), int((time.monotonic() - self.started) * self.baudrate / 10 * self.speed))
+
+    @property
+    def in_waiting(self):
+        return self.arrived() - self.position
+
+    def wait_for(self, size):
+        """
+        Block until size bytes are waiting, the timeout runs out or the capture ends
+        """
+        deadline = time.monotonic() + (self.timeout or 0)
+        while True:
+            waiting = self.in_waiting
+            if waiting >= size or self.position + waiting >= len(self.data):
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, (size - waiting) * 10 / (self.baudrate * self.speed)))
+        if self.position >= len(self.data) and self.stop_event:
+            self.stop_event.set()
+        return min(size, self.in_waiting)
+
+    def read(self, size = 1):
+        count = self.wait_for(size)
+        data = self.data[self.position:self.position + count]
+        self.position += count
+        return data
+
+    def readinto(self, buffer):
+        count = self.wait_for(len(buffer))
+        buffer[:count] = self.data[self.position:self.position + count]
+        self.position += count
+        return count
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        pass
+
+def damage(data, drop_rate, corrupt_rate, seed = 0):
+    """
+    Return (damaged bytes, bytes dropped, bytes corrupted)
+    """
+    if not drop_rate and not corrupt_rate:
+        return bytes(data), 0, 0
+    rng = np.random.default_rng(seed)
+    values = np.frombuffer(data, dtype=np.uint8).copy()
+    corrupt = rng.random(len(values)) < corrupt_rate
+    # Adding 1..255 mod 256 always changes the byte
+    values[corrupt] += rng.integers(1, 256, np.count_nonzero(corrupt), dtype=np.uint8)
+    keep = rng.random(len(values)) >= drop_rate
+    return values[keep].tobytes(), int(len(values) - np.count_nonzero(keep)), int(np.count_nonzero(corrupt))
+
+def load_capture(path):
+    """
+    Bytes of a capture file, or of every segment of a run given its .index file
+    Raw IMU captures (.raw) give the serial byte stream without their chunk markers
+    """
+    paths = [segment[0] for segment in read_index(path)] if path.endswith('.index') else [path]
+    data = bytearray()
+    for segment in paths:
+        if segment.endswith('.raw'):
+            data += read_chunks(segment)[1]
+            continue
+        with open(segment, 'rb') as file:
+            data += file.read()
+    return bytes(data)
+
+class NullWriter:
+    """
+    Discards what read_gnss would write to the rawx segments
+    """
+    def write(self, data, gps_time = None):
+        pass
+
+    def close(self):
+        pass
+
+def replay_gnss(data, speed = None, drop_rate = 0.0, corrupt_rate = 0.0, baudrate = 115200):
+    """
+    Run read_gnss over a capture and return its StreamHealth
+    """
+    stop_event = threading.Event()
+    gnss = ReplaySerial(data, baudrate, speed, drop_rate, corrupt_rate, timeout=0.1, stop_event=stop_event)
+    health = StreamHealth('GNSS replay')
+    health.started = time.monotonic()
+    health.running = True
+    read_gnss(gnss, NullWriter(), stop_event, health, debug=False)
+    health.running = False
+    return health, gnss
+
+def replay_imu(data, speed = None, drop_rate = 0.0, corrupt_rate = 0.0, baudrate = 460800):
+    """
+    Run the imu_datastream read loop over a raw byte dump and return its StreamHealth
+    """
+    stop_event = threading.Event()
+    imu = ReplaySerial(data, baudrate, speed, drop_rate, corrupt_rate, timeout=0.1, stop_event=stop_event)
+    health = StreamHealth('IMU replay')
+    health.started = time.monotonic()
+    health.running = True
+    framer = MipFramer()
+    with open(os.devnull, 'w') as log:
+        while not stop_event.is_set():
+            if read_stream_data(imu, log, framer, stop_event):
+                health.packet()
+            elif not stop_event.is_set():
+                health.error()
+    health.running = False
+    return health, imu
+
+if __name__ == "__main__":
+    kind, path = sys.argv[1], sys.argv[2]
+    speed = None if len(sys.argv) <= 3 or sys.argv[3] == 'max' else float(sys.argv[3])
+    drop_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    corrupt_rate = float(sys.argv[5]) if len(sys.argv) > 5 else 0.0
+    data = load_capture(path)
+    start = time.perf_counter()
+    health, port = (replay_gnss if kind == 'gnss' else replay_imu)(data, speed, drop_rate, corrupt_rate)
+    elapsed = time.perf_counter() - start
+    print(f"{len(data)} bytes ({port.dropped} dropped, {port.corrupted} corrupted) in {elapsed:.3f} s: "
+          f"{health.packets} packets ({health.packets / elapsed:.0f}/s, {len(data) / elapsed / 1e6:.2f} MB/s), {health.errors} errors")
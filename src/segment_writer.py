@@ -0,0 +1,124 @@
+import os
+import time
+
+class SegmentWriter:
+    """
+    Size/time bounded writer that rolls a long capture over into numbered segment files
+    prefix_0000.ext, prefix_0001.ext, ... each starting with the same header bytes.
+    Writes go through a preallocated buffer, segments are fsynced when closed, and
+    prefix.index records which GPS time range each closed segment covers. A segment is
+    listed provisionally as soon as it opens, so one cut short by a crash or power loss
+    is still found by read_index.
+    """
+    def __init__(self, prefix, extension, header = b'', max_bytes = 64 << 20, max_seconds = 3600, buffer_size = 1 << 18):
+        self.prefix = prefix
+        self.extension = extension
+        self.header = header
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.fill = 0
+        self.segment = -1
+        self.file = None
+        self.index_file = prefix + '.index'
+        self.open_segment()
+
+    def segment_path(self, segment):
+        return f"{self.prefix}_{segment:04d}{self.extension}"
+
+    def open_segment(self):
+        self.segment += 1
+        self.path = self.segment_path(self.segment)
+        self.file = open(self.path, 'wb', buffering=0)
+        self.opened = time.monotonic()
+        self.size = 0
+        self.first_time = None
+        self.last_time = None
+        self.write(self.header)
+        # On disk before the index names it, so a listed segment always has its header
+        self.flush()
+        self.write_index(None, None)
+
+    def close_segment(self):
+        self.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.write_index(self.first_time, self.last_time, self.size)
+
+    def write_index(self, start, end, size = -1):
+        """
+        Append the current segment's index line; size -1 marks a provisional entry for an open segment,
+        which the line written when it closes replaces
+        """
+        start = start or (None, None)
+        end = end or (None, None)
+        with open(self.index_file, 'a') as index:
+            index.write(f"{os.path.basename(self.path)},{start[0]},{start[1]},{end[0]},{end[1]},{size}\n")
+
+    def write_file(self, data):
+        # Unbuffered writes may be partial, so keep going until all of data is out
+        view = memoryview(data)
+        while view:
+            view = view[self.file.write(view):]
+
+    def flush(self):
+        if self.fill:
+            self.write_file(self.view[:self.fill])
+            self.fill = 0
+
+    def write(self, data, gps_time = None):
+        """
+        Write data, rolling over first if it would overrun the current segment
+        gps_time: optional (week, time_of_week) of the data, recorded in the index
+        """
+        if self.size > len(self.header) and (self.size + len(data) > self.max_bytes or time.monotonic() - self.opened > self.max_seconds):
+            self.close_segment()
+            self.open_segment()
+        length = len(data)
+        if self.fill + length > len(self.buffer):
+            self.flush()
+            if length > len(self.buffer):
+                self.write_file(data)
+                length = 0
+        if length:
+            self.view[self.fill:self.fill + length] = data
+            self.fill += length
+        self.size += len(data)
+        if gps_time is not None:
+            if self.first_time is None:
+                self.first_time = gps_time
+            self.last_time = gps_time
+
+    def close(self):
+        self.close_segment()
+
+def read_index(index_file):
+    """
+    Return a list of (segment path, start (week, tow), end (week, tow), size) from an index file
+    Times are None for segments that held no timestamped data or were never closed; those
+    are sized from the file as it was left, and skipped if nothing of them reached the disk
+    """
+    segments = {}
+    directory = os.path.dirname(index_file)
+    for line in open(index_file):
+        name, start_week, start_tow, end_week, end_tow, size = line.strip().split(',')
+        start = None if start_week == 'None' else (int(start_week), float(start_tow))
+        end = None if end_week == 'None' else (int(end_week), float(end_tow))
+        # The line written when a segment closes replaces its provisional one
+        segments[name] = (os.path.join(directory, name), start, end, int(size))
+    listed = []
+    for path, start, end, size in segments.values():
+        if size < 0:
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if not size:
+                continue
+        listed.append((path, start, end, size))
+    return listed
+
+def find_segments(index_file, start, end):
+    """
+    Segments whose GPS time range overlaps [start, end], both given as (week, tow)
+    """
+    return [segment for segment in read_index(index_file)
+            if segment[1] is not None and segment[1] <= end and segment[2] >= start]
@@ -0,0 +1,120 @@
+import time
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+
+'''
+Single-producer, single-consumer ring of byte chunks in shared memory
+
+Layout (native byte order, the ring never leaves the machine):
+    header      head u64, tail u64, overruns u64, packets u64, errors u64, closed u64
+                (head and closed are written by the producer, the rest by the consumer)
+    slots       sequence u64, monotonic_ns u64, length u32, then up to payload bytes
+
+The producer writes chunk n into slot n % slots and then advances head under the
+condition's lock, so the lock orders the slot contents before the new head for the
+consumer. The producer never waits for the consumer: a consumer more than slots behind
+skips ahead and counts the lost chunks as overruns, which the slot sequence numbers,
+checked before and after each chunk is handled, detect. The producer sets closed after
+its last write, so a consumer knows that once the ring is empty nothing more will arrive.
+'''
+
+HEADER = struct.Struct('=QQQQQQ')
+SLOT = struct.Struct('=QQI')
+SEQUENCE = struct.Struct('=Q')
+
+class ShmRing:
+    """
+    Create with ShmRing(slots, payload) in the parent; fork-started children inherit it
+    """
+    def __init__(self, slots = 1024, payload = 4096, context = None):
+        context = context or multiprocessing.get_context('fork')
+        self.slots = slots
+        self.payload = payload
+        self.slot_size = -(-(SLOT.size + payload) // 8) * 8
+        self.memory = shared_memory.SharedMemory(create=True, size=HEADER.size + slots * self.slot_size)
+        self.buffer = self.memory.buf
+        HEADER.pack_into(self.buffer, 0, 0, 0, 0, 0, 0, 0)
+        self.condition = context.Condition()
+
+    def field(self, index):
+        return struct.unpack_from('=Q', self.buffer, index * 8)[0]
+
+    def set_field(self, index, value):
+        struct.pack_into('=Q', self.buffer, index * 8, value)
+
+    head = property(lambda self: self.field(0), lambda self, value: self.set_field(0, value))
+    tail = property(lambda self: self.field(1), lambda self, value: self.set_field(1, value))
+    overruns = property(lambda self: self.field(2), lambda self, value: self.set_field(2, value))
+    packets = property(lambda self: self.field(3), lambda self, value: self.set_field(3, value))
+    errors = property(lambda self: self.field(4), lambda self, value: self.set_field(4, value))
+    closed = property(lambda self: self.field(5), lambda self, value: self.set_field(5, value))
+
+    def offset(self, sequence):
+        return HEADER.size + (sequence % self.slots) * self.slot_size
+
+    def write(self, data, timestamp = None):
+        """
+        Producer: append data (split over several slots if needed) and wake the consumer
+        """
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        sequence = self.head
+        for start in range(0, len(data), self.payload):
+            piece = data[start:start + self.payload]
+            offset = self.offset(sequence)
+            SLOT.pack_into(self.buffer, offset, sequence, timestamp, len(piece))
+            self.buffer[offset + SLOT.size:offset + SLOT.size + len(piece)] = piece
+            sequence += 1
+        with self.condition:
+            self.head = sequence
+            self.condition.notify_all()
+
+    def consume(self, handler, timeout = 0.1):
+        """
+        Consumer: call handler(view, monotonic_ns) for every chunk written since the last call,
+        waiting up to timeout for one; views point into shared memory and are only valid during the call
+        Returns the number of chunks handled
+        """
+        with self.condition:
+            if self.head == self.tail:
+                self.condition.wait(timeout)
+            head = self.head
+        tail = self.tail
+        if head - tail > self.slots:
+            self.overruns += head - tail - self.slots
+            tail = head - self.slots
+        for sequence in range(tail, head):
+            offset = self.offset(sequence)
+            written, timestamp, length = SLOT.unpack_from(self.buffer, offset)
+            if written != sequence:
+                # Already reused by a write whose head is not published yet
+                self.overruns += 1
+                continue
+            handler(self.buffer[offset + SLOT.size:offset + SLOT.size + length], timestamp)
+            # The producer rewrites a slot's sequence before its payload, so a slot reused
+            # while it was being handled shows a new sequence and may have been torn
+            if SEQUENCE.unpack_from(self.buffer, offset)[0] != sequence:
+                self.overruns += 1
+        self.tail = head
+        return head - tail
+
+    def close_producer(self):
+        """
+        Producer: mark the ring closed after the last write and wake the consumer
+        """
+        with self.condition:
+            self.closed = 1
+            self.condition.notify_all()
+
+    def summary(self):
+        return f"ring={self.head - self.tail}/{self.slots} overruns={self.overruns}"
+
+    def close(self):
+        """
+        Release the mapping; the creator also unlinks it once every process is done
+        """
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
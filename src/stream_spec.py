@@ -0,0 +1,90 @@
+'''
+Declarative description of the 3DM-CV7 0x80 (sensor data) stream
+
+A stream spec is a list of (field, rate in Hz) pairs, e.g. [('accel', 1000), ('gyro', 500)].
+configuration builds the message format command and checks the link budget from it, and
+imu_datastream and imu_log derive the packet and record layouts from the same spec.
+The GPS timestamp field is always added at the fastest rate so every packet is timestamped.
+'''
+
+IMU_BASE_RATE = 1000 # Hz, base rate of the 0x80 descriptor set; field rates must divide it
+IMU_BAUD = 460800
+LINK_HEADROOM = 0.9 # share of the UART the stream may use
+MIP_OVERHEAD = 6 # sync, descriptor set, payload length and checksum
+
+# name: (field descriptor, [(column, big-endian format)], scale to SI units)
+SENSOR_FIELDS = {
+    'gps_time': (0xD3, [('time_of_week', '>f8'), ('week_number', '>u2'), ('valid_flags', '>u2')], None),
+    'accel': (0x04, [('x', '>f4'), ('y', '>f4'), ('z', '>f4')], 9.80665), # g -> m/s^2
+    'gyro': (0x05, [('gyro_x', '>f4'), ('gyro_y', '>f4'), ('gyro_z', '>f4')], 1.0), # rad/s
+    'mag': (0x06, [('mag_x', '>f4'), ('mag_y', '>f4'), ('mag_z', '>f4')], 1.0), # Gauss
+    'delta_theta': (0x07, [('delta_theta_x', '>f4'), ('delta_theta_y', '>f4'), ('delta_theta_z', '>f4')], 1.0), # rad
+    'delta_velocity': (0x08, [('delta_velocity_x', '>f4'), ('delta_velocity_y', '>f4'), ('delta_velocity_z', '>f4')], 9.80665), # g*s -> m/s
+}
+FIELD_NAMES = {descriptor: name for name, (descriptor, columns, scale) in SENSOR_FIELDS.items()}
+FORMAT_SIZES = {'f8': 8, 'f4': 4, 'u2': 2}
+
+DEFAULT_STREAM = [('accel', IMU_BASE_RATE)]
+
+def field_size(name):
+    """
+    Bytes a field takes in a packet, including its length and descriptor bytes
+    """
+    return 2 + sum(FORMAT_SIZES[fmt[1:]] for column, fmt in SENSOR_FIELDS[name][1])
+
+def resolve_stream(spec):
+    """
+    Validate a spec and return [(field, decimation)] with the GPS timestamp first
+    Raises ValueError for unknown fields or rates the base rate cannot be divided down to
+    """
+    fields = []
+    for name, rate in spec:
+        if name not in SENSOR_FIELDS or name == 'gps_time':
+            raise ValueError(f"Unknown IMU stream field: {name!r}")
+        if rate <= 0 or IMU_BASE_RATE % rate:
+            raise ValueError(f"{name} rate {rate} Hz does not divide the {IMU_BASE_RATE} Hz base rate")
+        fields.append((name, IMU_BASE_RATE // rate))
+    if not fields:
+        raise ValueError("IMU stream spec is empty")
+    return [('gps_time', min(decimation for name, decimation in fields))] + fields
+
+def stream_bytes_per_second(spec):
+    """
+    Bytes per second the stream puts on the UART
+    Packets go out at the fastest field's rate; slower fields ride along in some of them
+    """
+    fields = resolve_stream(spec)
+    packets = IMU_BASE_RATE / fields[0][1]
+    return packets * MIP_OVERHEAD + sum(field_size(name) * IMU_BASE_RATE / decimation for name, decimation in fields)
+
+def check_stream(spec, baud = IMU_BAUD):
+    """
+    Return the stream's bytes/s, raising ValueError if it would not fit on the link
+    """
+    needed = stream_bytes_per_second(spec)
+    capacity = baud / 10
+    if needed > capacity * LINK_HEADROOM:
+        raise ValueError(f"IMU stream needs {needed:.0f} B/s but {baud} baud carries {capacity:.0f} B/s; lower the field rates")
+    return needed
+
+def message_format(spec):
+    """
+    Payload of the 0x0C 0x0F (message format) command that sets up the 0x80 stream
+    """
+    fields = resolve_stream(spec)
+    payload = bytes([0x01, 0x80, len(fields)])
+    for name, decimation in fields:
+        payload += bytes([SENSOR_FIELDS[name][0], decimation >> 8, decimation & 0xFF])
+    return payload
+
+def sample_columns(spec):
+    """
+    Names of the per-sample value columns the spec produces (timestamp excluded)
+    """
+    return [column for name, rate in (spec or DEFAULT_STREAM) for column, fmt in SENSOR_FIELDS[name][1]]
+
+def sample_interval(spec):
+    """
+    Seconds between timestamped packets, i.e. the period of the fastest field
+    """
+    return resolve_stream(spec or DEFAULT_STREAM)[0][1] / IMU_BASE_RATE
@@ -0,0 +1,115 @@
+import json
+import socket
+import threading
+import time
+from datetime import datetime
+
+class StreamHealth:
+    """
+    Counters shared between one reader thread and the supervisor
+    """
+    def __init__(self, name):
+        self.name = name
+        self.packets = 0
+        self.errors = 0
+        self.started = None
+        self.last_packet = None
+        self.running = False
+        self.exception = None
+        self.queue = None
+        self.metrics = None
+
+    def packet(self):
+        self.packets += 1
+        self.last_packet = time.monotonic()
+
+    def error(self):
+        self.errors += 1
+
+    def status(self, stall_timeout):
+        if self.exception is not None:
+            return "FAILED"
+        if not self.running:
+            return "STOPPED"
+        if self.last_packet is None or time.monotonic() - self.last_packet > stall_timeout:
+            return "STALLED"
+        return "OK"
+
+    def summary(self, stall_timeout):
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        rate = self.packets / elapsed if elapsed > 0 else 0.0
+        message = f"{self.name}: {self.status(stall_timeout)} packets={self.packets} errors={self.errors} rate={rate:.1f} Hz"
+        if self.queue is not None:
+            message += " " + self.queue.summary()
+        if self.exception is not None:
+            message += f" ({self.exception!r})"
+        return message
+
+def run_capture(streams, log_file, report_interval = 10.0, stall_timeout = 5.0, metrics_file = None, metrics_address = None):
+    """
+    Run every stream reader concurrently until Ctrl-C, reporting health periodically
+    streams: dict of name -> reader(stop_event, health)
+    metrics_file / metrics_address: where each report also sends the readers' metrics snapshots,
+    as JSON lines appended to a file and/or JSON datagrams to a local UDP (host, port)
+    """
+    stop_event = threading.Event()
+    health = {name: StreamHealth(name) for name in streams}
+    threads = []
+    for name, reader in streams.items():
+        thread = threading.Thread(target=run_stream, args=(reader, stop_event, health[name]), name=name, daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            if stop_event.wait(report_interval):
+                break
+            report_health(health, log_file, stall_timeout)
+            report_metrics(health, metrics_file, metrics_address)
+    except KeyboardInterrupt:
+        print("\nStopping capture...")
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+        report_health(health, log_file, stall_timeout)
+        report_metrics(health, metrics_file, metrics_address)
+    return health
+
+def run_stream(reader, stop_event, health):
+    """
+    Thread body: run a reader and record how it ended
+    """
+    health.started = time.monotonic()
+    health.running = True
+    try:
+        reader(stop_event, health)
+    except Exception as e:
+        health.exception = e
+        print(f"{health.name} stream failed: {e!r}")
+    finally:
+        health.running = False
+
+def report_health(health, log_file, stall_timeout):
+    log = open(log_file, 'a')
+    log.write(f"Capture health at {datetime.now().strftime('%Y-%m-%d_%H-%M-%S.%f')}\n")
+    for stream in health.values():
+        message = stream.summary(stall_timeout)
+        print(message)
+        log.write(message + '\n')
+    log.close()
+
+def report_metrics(health, metrics_file = None, metrics_address = None):
+    snapshots = [json.dumps(stream.metrics.snapshot()) for stream in health.values() if stream.metrics is not None]
+    if not snapshots:
+        return
+    if metrics_file:
+        metrics = open(metrics_file, 'a')
+        for snapshot in snapshots:
+            metrics.write(snapshot + '\n')
+        metrics.close()
+    if metrics_address:
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for snapshot in snapshots:
+            sender.sendto(snapshot.encode(), metrics_address)
+        sender.close()
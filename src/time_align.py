@@ -0,0 +1,146 @@
+import sys
+import numpy as np
+from imu_log import read_run, read_samples
+from segment_writer import read_index
+from ubx_decoder import decode_capture
+
+'''
+Align IMU samples with GNSS measurement epochs by GPS time
+
+Both streams carry GPS (week, time of week): the IMU stamps each packet from its
+PPS-disciplined clock and RXM-RAWX carries the receiver time of each epoch. Times are
+turned into seconds from a common reference week, which also takes care of week
+rollover, and IMU columns are linearly interpolated onto the epochs with one
+sorted search, O((n + m) log n) rather than a scan per epoch.
+'''
+
+SECONDS_PER_WEEK = 604800
+
+def gps_seconds(week, time_of_week, reference_week):
+    """
+    Seconds since the start of reference_week; keeps float64 at sub-microsecond precision
+    """
+    return (np.asarray(week, dtype=np.int64) - reference_week) * SECONDS_PER_WEEK + np.asarray(time_of_week, dtype=np.float64)
+
+def load_imu(path):
+    """
+    Read an IMU sample log (a segment or a run's .index) as (week, tow, {column: values})
+    """
+    config, samples = read_run(path) if path.endswith('.index') else read_samples(path)
+    columns = {name: samples[name].astype(np.float64) for name in samples.dtype.names[2:]}
+    return samples['week_number'], samples['time_of_week'], columns
+
+def load_gnss(path):
+    """
+    Decode a rawx capture (a segment or a run's .index) into (week, rcv_tow) per epoch and the TIM-TP records
+    """
+    paths = [segment[0] for segment in read_index(path)] if path.endswith('.index') else [path]
+    weeks, tows, tim_tp = [], [], []
+    for segment in paths:
+        decoded = decode_capture(segment)
+        rawx = decoded['rawx']
+        # One row per measurement; keep the first row of each epoch
+        first = np.flatnonzero(np.diff(rawx['epoch'], prepend=-1))
+        weeks.append(rawx['week'][first])
+        tows.append(rawx['rcv_tow'][first])
+        tim_tp.append(decoded['tim_tp'])
+    if not paths:
+        return np.zeros(0, dtype=np.uint16), np.zeros(0), np.zeros(0)
+    return np.concatenate(weeks), np.concatenate(tows), np.concatenate(tim_tp)
+
+def sort_by_time(time, columns):
+    """
+    Order samples by time, dropping repeated timestamps (e.g. from overlapping segments)
+    """
+    if len(time) and np.all(np.diff(time) > 0):
+        return time, columns
+    time, order = np.unique(time, return_index=True)
+    return time, {name: values[order] for name, values in columns.items()}
+
+def align(imu_time, columns, epoch_time, max_gap = None):
+    """
+    Interpolate each IMU column onto the epoch times
+    Epochs outside the IMU record, or whose bracketing samples are more than max_gap apart
+    (default: 5 median sample periods), are NaN and False in the returned 'valid' mask
+    """
+    imu_time, columns = sort_by_time(imu_time, columns)
+    epoch_time = np.asarray(epoch_time, dtype=np.float64)
+    if len(imu_time) < 2:
+        nan = np.full(len(epoch_time), np.nan)
+        return dict({name: nan.copy() for name in columns}, valid=np.zeros(len(epoch_time), dtype=bool))
+    if max_gap is None:
+        max_gap = 5 * np.median(np.diff(imu_time))
+    after = np.clip(np.searchsorted(imu_time, epoch_time), 1, len(imu_time) - 1)
+    valid = ((epoch_time >= imu_time[0]) & (epoch_time <= imu_time[-1])
+             & (imu_time[after] - imu_time[after - 1] <= max_gap))
+    aligned = {}
+    for name, values in columns.items():
+        # np.interp does the same sorted search internally, in C
+        interpolated = np.interp(epoch_time, imu_time, values)
+        interpolated[~valid] = np.nan
+        aligned[name] = interpolated
+    aligned['valid'] = valid
+    return aligned
+
+def grid_statistics(time):
+    """
+    Fit a regular sample grid to a time series: its period, the phase of the grid against
+    whole GPS seconds (offset), the scatter of samples about it (jitter) and the number of gaps
+    """
+    if len(time) < 2:
+        return {'period': np.nan, 'offset': np.nan, 'jitter': np.nan, 'gaps': 0}
+    deltas = np.diff(time)
+    nominal = np.median(deltas)
+    # Sample numbers on the grid, so gaps do not bias the fitted period
+    count = np.round((time - time[0]) / nominal)
+    period, intercept = np.polyfit(count, time - time[0], 1)
+    residual = time - time[0] - (intercept + period * count)
+    start = time[0] + intercept
+    return {
+        'period': period,
+        'offset': (start + period / 2) % period - period / 2,
+        'jitter': residual.std(),
+        'gaps': int(np.count_nonzero(deltas > 1.5 * nominal)),
+    }
+
+def clock_statistics(imu_time, epoch_time, tim_tp = None):
+    """
+    Offset/jitter of each stream against its own sample grid, the IMU sample phase at each
+    GNSS epoch, and the TIM-TP quantisation error of the PPS if it was recorded
+    """
+    imu_time = np.unique(imu_time)
+    epoch_time = np.asarray(epoch_time, dtype=np.float64)
+    statistics = {'imu': grid_statistics(imu_time), 'gnss': grid_statistics(epoch_time)}
+    inside = (epoch_time >= imu_time[0]) & (epoch_time <= imu_time[-1]) if len(imu_time) else np.zeros(len(epoch_time), dtype=bool)
+    if inside.any():
+        before = imu_time[np.searchsorted(imu_time, epoch_time[inside], side='right') - 1]
+        phase = epoch_time[inside] - before
+        statistics['phase'] = {'mean': phase.mean(), 'std': phase.std(), 'max': phase.max()}
+    if tim_tp is not None and len(tim_tp):
+        q_err = tim_tp['q_err'] * 1e-12 # ps -> s
+        statistics['pps_q_err'] = {'mean': q_err.mean(), 'std': q_err.std()}
+    return statistics
+
+def align_files(imu_path, gnss_path, output = None):
+    """
+    Align an IMU log with a rawx capture; returns (aligned columns per epoch, clock statistics)
+    and optionally saves both the epoch times and the aligned columns to a .npz file
+    """
+    imu_week, imu_tow, columns = load_imu(imu_path)
+    gnss_week, gnss_tow, tim_tp = load_gnss(gnss_path)
+    weeks = np.concatenate([imu_week, gnss_week])
+    reference_week = int(weeks.min()) if len(weeks) else 0
+    imu_time = gps_seconds(imu_week, imu_tow, reference_week)
+    epoch_time = gps_seconds(gnss_week, gnss_tow, reference_week)
+    aligned = align(imu_time, columns, epoch_time)
+    statistics = clock_statistics(imu_time, epoch_time, tim_tp)
+    if output:
+        np.savez(output, reference_week=reference_week, epoch_time=epoch_time, **aligned)
+    return aligned, statistics
+
+if __name__ == "__main__":
+    # python time_align.py <imu .bin or .index> <rawx .ubx or .index> [output.npz]
+    aligned, statistics = align_files(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    print(f"{np.count_nonzero(aligned['valid'])} of {len(aligned['valid'])} GNSS epochs inside the IMU record")
+    for name, values in statistics.items():
+        print(f"{name}: " + ", ".join(f"{key}={value * 1e6:.3f} us" if key != 'gaps' else f"{key}={value}" for key, value in values.items()))
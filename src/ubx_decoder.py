@@ -0,0 +1,172 @@
+import mmap
+import sys
+import numpy as np
+from checksum import fletcher_checksum
+
+'''
+Offline decoder for .ubx captures written by gnss_datastream.read_gnss
+The capture is memory-mapped, message offsets are indexed in one pass, and the
+messages of interest are decoded into columnar NumPy arrays with vectorised gathers
+'''
+
+UBX_SYNC = bytes([0xB5, 0x62])
+RXM_RAWX = (0x02, 0x15)
+TIM_TP = (0x0D, 0x01)
+NAV_TIMEGPS = (0x01, 0x20)
+
+INDEX_DTYPE = np.dtype([
+    ('offset', '<i8'),  # offset of the payload in the file
+    ('class', 'u1'),
+    ('id', 'u1'),
+    ('length', '<u2'),
+])
+
+RAWX_HEADER_DTYPE = np.dtype([
+    ('rcv_tow', '<f8'),
+    ('week', '<u2'),
+    ('leap_s', 'i1'),
+    ('num_meas', 'u1'),
+    ('rec_stat', 'u1'),
+    ('reserved', 'u1', 3),
+])
+
+RAWX_MEAS_DTYPE = np.dtype([
+    ('pseudorange', '<f8'),
+    ('carrier_phase', '<f8'),
+    ('doppler', '<f4'),
+    ('gnss_id', 'u1'),
+    ('sv_id', 'u1'),
+    ('sig_id', 'u1'),
+    ('freq_id', 'u1'),
+    ('lock_time', '<u2'),
+    ('cno', 'u1'),
+    ('pr_stdev', 'u1'),
+    ('cp_stdev', 'u1'),
+    ('do_stdev', 'u1'),
+    ('trk_stat', 'u1'),
+    ('reserved', 'u1'),
+])
+
+TIM_TP_DTYPE = np.dtype([
+    ('tow_ms', '<u4'),
+    ('tow_sub_ms', '<u4'),
+    ('q_err', '<i4'),
+    ('week', '<u2'),
+    ('flags', 'u1'),
+    ('ref_info', 'u1'),
+])
+
+NAV_TIMEGPS_DTYPE = np.dtype([
+    ('itow', '<u4'),
+    ('ftow', '<i4'),
+    ('week', '<i2'),
+    ('leap_s', 'i1'),
+    ('valid', 'u1'),
+    ('t_acc', '<u4'),
+])
+
+def open_capture(path):
+    """
+    Memory-map a capture read-only; empty files give an empty buffer
+    """
+    with open(path, 'rb') as file:
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b''
+
+def index_messages(data):
+    """
+    Walk the capture once and return the offsets of every checksum-valid message
+    Garbage between messages is skipped by searching for the next sync pair
+    """
+    view = memoryview(data)
+    entries = []
+    position = 0
+    size = len(data)
+    while True:
+        start = data.find(UBX_SYNC, position)
+        if start < 0 or size - start < 8:
+            break
+        length = data[start + 4] | data[start + 5] << 8
+        end = start + 8 + length
+        if end > size or fletcher_checksum(view[start + 2:end - 2]) != view[end - 2:end]:
+            position = start + 1
+            continue
+        entries.append((start + 6, data[start + 2], data[start + 3], length))
+        position = end
+    view.release()
+    return np.array(entries, dtype=INDEX_DTYPE)
+
+def gather(data, offsets, dtype):
+    """
+    Copy dtype.itemsize bytes from each offset into a structured array in one call
+    """
+    raw = np.frombuffer(data, dtype=np.uint8) if len(data) else np.zeros(0, dtype=np.uint8)
+    rows = raw[offsets[:, None] + np.arange(dtype.itemsize)]
+    return rows.view(dtype).reshape(len(offsets))
+
+def select(index, message, minimum_length):
+    return index[(index['class'] == message[0]) & (index['id'] == message[1]) & (index['length'] >= minimum_length)]
+
+def decode_rawx(data, index):
+    """
+    Flatten every RXM-RAWX measurement into columns, one row per satellite signal per epoch
+    """
+    messages = select(index, RXM_RAWX, RAWX_HEADER_DTYPE.itemsize)
+    headers = gather(data, messages['offset'], RAWX_HEADER_DTYPE)
+    # Trust numMeas only as far as the payload length allows
+    counts = np.minimum(headers['num_meas'], (messages['length'] - RAWX_HEADER_DTYPE.itemsize) // RAWX_MEAS_DTYPE.itemsize).astype(np.int64)
+    epoch = np.repeat(np.arange(len(messages)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    slot = np.arange(len(epoch)) - first
+    offsets = messages['offset'][epoch] + RAWX_HEADER_DTYPE.itemsize + slot * RAWX_MEAS_DTYPE.itemsize
+    measurements = gather(data, offsets, RAWX_MEAS_DTYPE)
+    return {
+        'epoch': epoch,
+        'rcv_tow': headers['rcv_tow'][epoch],
+        'week': headers['week'][epoch],
+        'leap_s': headers['leap_s'][epoch],
+        'gnss_id': measurements['gnss_id'],
+        'sv_id': measurements['sv_id'],
+        'sig_id': measurements['sig_id'],
+        'pseudorange': measurements['pseudorange'],
+        'carrier_phase': measurements['carrier_phase'],
+        'doppler': measurements['doppler'],
+        'cno': measurements['cno'],
+        'lock_time': measurements['lock_time'],
+        'trk_stat': measurements['trk_stat'],
+    }
+
+def decode_capture(path):
+    """
+    Decode RXM-RAWX, TIM-TP and NAV-TIMEGPS from a capture
+    Returns a dictionary of {'index', 'rawx', 'tim_tp', 'nav_timegps'}
+    """
+    data = open_capture(path)
+    index = index_messages(data)
+    return {
+        'index': index,
+        'rawx': decode_rawx(data, index),
+        'tim_tp': gather(data, select(index, TIM_TP, TIM_TP_DTYPE.itemsize)['offset'], TIM_TP_DTYPE),
+        'nav_timegps': gather(data, select(index, NAV_TIMEGPS, NAV_TIMEGPS_DTYPE.itemsize)['offset'], NAV_TIMEGPS_DTYPE),
+    }
+
+def save_capture(path, output):
+    """
+    Decode a capture and save the columns to a .npz file
+    """
+    decoded = decode_capture(path)
+    columns = {'rawx_' + name: values for name, values in decoded['rawx'].items()}
+    np.savez(output, index=decoded['index'], tim_tp=decoded['tim_tp'], nav_timegps=decoded['nav_timegps'], **columns)
+    return decoded
+
+if __name__ == "__main__":
+    # python ubx_decoder.py <capture.ubx> [output.npz]
+    if len(sys.argv) > 2:
+        decoded = save_capture(sys.argv[1], sys.argv[2])
+    else:
+        decoded = decode_capture(sys.argv[1])
+    rawx = decoded['rawx']
+    print(f"{len(decoded['index'])} messages, {len(np.unique(rawx['epoch']))} RAWX epochs, {len(rawx['epoch'])} measurements, "
+          f"{len(decoded['tim_tp'])} TIM-TP, {len(decoded['nav_timegps'])} NAV-TIMEGPS")
@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import deque
+
+class WriteQueue:
+    """
+    Bounded queue between a serial reader and a writer thread
+    put() never blocks the reader: when the queue is full the new item is dropped and counted.
+    The writer thread hands items to consumer(batch) in batches and then calls flush(),
+    timing each batch so a slow disk shows up as flush latency and queue depth.
+    latency: optional metrics.Histogram that also receives each batch's time
+    """
+    def __init__(self, consumer, flush = None, depth = 4096, batch_size = 256, flush_interval = 0.25, name = 'writer', latency = None):
+        self.consumer = consumer
+        self.flush = flush
+        self.depth = depth
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.latency = latency
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.flushes = 0
+        self.last_flush = 0.0
+        self.max_flush = 0.0
+        self.exception = None
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        """
+        Queue an item for the writer; returns False if it was dropped
+        """
+        with self.condition:
+            if len(self.items) >= self.depth:
+                self.dropped += 1
+                return False
+            self.items.append(item)
+            self.queued += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            if len(self.items) >= self.batch_size:
+                self.condition.notify()
+        return True
+
+    def run(self):
+        """
+        Writer thread body: drain batches until closed and empty
+        """
+        while True:
+            with self.condition:
+                if not self.closed and len(self.items) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                if self.closed and not self.items:
+                    return
+                batch = [self.items.popleft() for _ in range(min(len(self.items), self.batch_size))]
+            if not batch:
+                continue
+            start = time.monotonic()
+            try:
+                self.consumer(batch)
+                if self.flush:
+                    self.flush()
+            except Exception as e:
+                # Keep draining so the reader is never blocked behind a dead writer
+                self.exception = e
+                print(f"{self.thread.name} failed: {e!r}")
+            elapsed = time.monotonic() - start
+            self.written += len(batch)
+            self.flushes += 1
+            self.last_flush = elapsed
+            self.max_flush = max(self.max_flush, elapsed)
+            if self.latency is not None:
+                self.latency.record(int(elapsed * 1e9))
+
+    def close(self):
+        """
+        Write out everything still queued and stop the writer thread
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def summary(self):
+        return (f"queue={len(self.items)}/{self.depth} max={self.max_depth} dropped={self.dropped} "
+                f"flush={self.last_flush * 1000:.1f} ms (max {self.max_flush * 1000:.1f} ms)")
+
+class SharedLog:
+    """
+    Text log written from both a reader and its writer thread
+    File objects are not safe to share between threads, so every write and flush takes a lock
+    """
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            return self.file.write(text)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()